@@ -0,0 +1,352 @@
+r"""
+Benchmarks for SourceSeeker on a deterministic synthetic corpus. Headless, like finder_cli.py.
+
+    python finder_bench.py generate bench_corpus --originals 200 --max-megapixels 50
+    python finder_bench.py run bench_corpus --report bench_v1.json
+    python finder_bench.py compare bench_v1.json bench_v2.json
+
+The corpus is built offline from a seed, so the same arguments give the same files on any
+machine. Each original gets resized, re-encoded and renamed variants, and a low-res reference
+in refs/; manifest.json records which library files every reference should find.
+The report is JSON with one entry per benchmark, so runs of two versions can be compared.
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import multiprocessing
+
+from PIL import Image, ImageDraw
+
+import finder_core as core
+
+# Size tiers: (name, width, height, weight). Anything above --max-megapixels is left out.
+SIZE_TIERS = [
+    ("icon", 32, 32, 10),
+    ("small", 640, 480, 30),
+    ("hd", 1920, 1080, 35),
+    ("12mp", 4000, 3000, 20),
+    ("24mp", 6000, 4000, 4),
+    ("50mp", 8660, 5773, 1),
+]
+
+# Lossless formats get large fast; above this many megapixels originals are written as JPEG
+LOSSLESS_MAX_MEGAPIXELS = 4
+
+FORMATS = {".jpg": "JPEG", ".jpeg": "JPEG", ".png": "PNG", ".bmp": "BMP", ".webp": "WEBP", ".tiff": "TIFF"}
+
+REF_WIDTH = 200
+FILES_PER_DIR = 50
+
+# --- CORPUS ---
+def draw_original(rng, width, height):
+    """ Random shapes on a gradient, drawn small and scaled up so 50 MP images stay cheap to make. """
+    base = Image.linear_gradient("L").rotate(rng.choice((0, 90, 180, 270))).convert("RGB")
+    draw = ImageDraw.Draw(base)
+    for _ in range(rng.randint(8, 24)):
+        x0, y0 = rng.randint(0, 200), rng.randint(0, 200)
+        box = [x0, y0, x0 + rng.randint(16, 128), y0 + rng.randint(16, 128)]
+        fill = tuple(rng.randint(0, 255) for _ in range(3))
+        if rng.random() < 0.5:
+            draw.rectangle(box, fill=fill)
+        else:
+            draw.ellipse(box, fill=fill)
+    return base.resize((width, height), Image.BILINEAR)
+
+def save_image(img, path):
+    fmt = FORMATS[os.path.splitext(path)[1].lower()]
+    if fmt == "JPEG":
+        img.save(path, fmt, quality=90)
+    elif fmt == "WEBP":
+        img.save(path, fmt, quality=80)
+    else:
+        img.save(path, fmt)
+
+def generate_corpus(root, originals=200, seed=1, max_megapixels=50, force=False):
+    """
+    Writes root/library (originals and their variants) and root/refs, plus root/manifest.json
+    with the parameters and {ref: [library paths it should match]}. Returns the manifest.
+    A previous corpus in root is replaced; any other non-empty root raises ValueError
+    unless `force` is set, in which case it is deleted.
+    """
+    rng = random.Random(seed)
+    tiers = [t for t in SIZE_TIERS if t[1] * t[2] <= max_megapixels * 1_000_000]
+    extensions = sorted(core.IMAGE_EXTENSIONS)
+    library = os.path.join(root, "library")
+    refs_dir = os.path.join(root, "refs")
+    manifest_path = os.path.join(root, "manifest.json")
+    if force:
+        shutil.rmtree(root, ignore_errors=True)
+    elif os.path.isdir(root) and os.listdir(root):
+        if not os.path.isfile(manifest_path):
+            raise ValueError(f"{root} is not empty and holds no corpus (use --force to delete it)")
+        # Only what an earlier run wrote goes; anything else in root is left alone
+        shutil.rmtree(library, ignore_errors=True)
+        shutil.rmtree(refs_dir, ignore_errors=True)
+        os.remove(manifest_path)
+    os.makedirs(refs_dir)
+
+    expected = {}
+    count = 0
+
+    def place(filename):
+        nonlocal count
+        folder = os.path.join(library, f"d{count // FILES_PER_DIR:03d}")
+        os.makedirs(folder, exist_ok=True)
+        count += 1
+        return os.path.join(folder, filename)
+
+    for i in range(originals):
+        name, width, height, _ = rng.choices(tiers, weights=[t[3] for t in tiers])[0]
+        ext = extensions[i % len(extensions)]
+        if width * height > LOSSLESS_MAX_MEGAPIXELS * 1_000_000:
+            ext = ".jpg"
+        img = draw_original(rng, width, height)
+        original = place(f"img{i:05d}_{name}{ext}")
+        save_image(img, original)
+        matches = [original]
+
+        # Resized: same format, 25-60% of the size
+        scale = rng.uniform(0.25, 0.6)
+        resized = place(f"img{i:05d}_resized{ext}")
+        save_image(img.resize((max(1, int(width * scale)), max(1, int(height * scale))), Image.BILINEAR), resized)
+        matches.append(resized)
+
+        # Re-encoded: another format, lossy where possible
+        other = rng.choice([e for e in (".jpg", ".webp", ".png") if e != ext])
+        reencoded = place(f"img{i:05d}_reencoded{other}")
+        save_image(img, reencoded)
+        matches.append(reencoded)
+
+        # Renamed: identical bytes under an unrelated name
+        renamed = place(f"copy_{rng.getrandbits(32):08x}{ext}")
+        shutil.copyfile(original, renamed)
+        matches.append(renamed)
+
+        ref = os.path.join(refs_dir, f"ref{i:05d}.png")
+        img.resize((REF_WIDTH, max(1, height * REF_WIDTH // width)), Image.BILINEAR).save(ref)
+        expected[os.path.relpath(ref, root)] = [os.path.relpath(p, root) for p in matches]
+
+    manifest = {
+        "seed": seed,
+        "originals": originals,
+        "max_megapixels": max_megapixels,
+        "files": count,
+        "bytes": sum(e.stat().st_size for d in os.scandir(library) for e in os.scandir(d.path)),
+        "expected": expected,
+    }
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1)
+    return manifest
+
+# --- BENCHMARKS ---
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    value = func(*args, **kwargs)
+    return value, time.perf_counter() - start
+
+def score(root, expected, results):
+    """ (found, missed, unexpected) counts for matches of the given refs against the manifest. """
+    found = missed = unexpected = 0
+    for ref, paths in results.items():
+        want = {os.path.normpath(os.path.join(root, p)) for p in expected[ref]}
+        got = {os.path.normpath(p) for p in paths}
+        found += len(want & got)
+        missed += len(want - got)
+        unexpected += len(got - want)
+    return found, missed, unexpected
+
+def query_paths(folder, ref, **kwargs):
+    return [m["path"] for m in core.query(folder, ref, **kwargs)]
+
+def bench_db_writes(db_path, rows, seed):
+    """ Rows per second through IndexWriter into an empty database. """
+    rng = random.Random(seed)
+    saved = core.DB_NAME
+    core.DB_NAME = db_path
+    try:
+        core.init_db()
+        writer = core.IndexWriter()
+        start = time.perf_counter()
+        for i in range(rows):
+            value = rng.getrandbits(64) - (1 << 63) # p_hash is stored signed
+            writer.add(f"/bench/d{i // 1000:05d}/img{i:07d}.png", 1_600_000_000.0 + i, {"ahash": value})
+        writer.close()
+        seconds = time.perf_counter() - start
+    finally:
+        core.DB_NAME = saved
+    return {"rows": rows, "seconds": round(seconds, 4), "rows_per_second": round(rows / seconds)}
+
+def run_benchmarks(root, queries=20, write_rows=100_000, pool_kind=core.HASH_POOL, workers=core.HASH_WORKERS,
+                   on_status=None):
+    """ Runs every benchmark against a corpus from generate_corpus() and returns the report dict. """
+    with open(os.path.join(root, "manifest.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    library = os.path.join(root, "library")
+    expected = manifest["expected"]
+    refs = sorted(expected)
+    kw = {"pool_kind": pool_kind, "workers": workers}
+    results = {}
+
+    def log(text):
+        if on_status:
+            on_status("status", text)
+
+    # Scans run against a fresh database next to the corpus
+    db_path = os.path.join(root, "bench.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_path + suffix):
+            os.remove(db_path + suffix)
+    saved = core.DB_NAME, core.INCREMENTAL_SCAN
+    core.DB_NAME = db_path
+    try:
+        core.init_db()
+
+        log("Cold scan...")
+        count, seconds = timed(core.index_root, library, **kw)
+        results["cold_scan"] = {"files": count, "seconds": round(seconds, 4),
+                                "files_per_second": round(count / seconds, 1)}
+
+        log("Warm rescan...")
+        count, seconds = timed(core.index_root, library, **kw)
+        results["warm_rescan"] = {"files": count, "seconds": round(seconds, 4)}
+
+        core.INCREMENTAL_SCAN = False
+        count, seconds = timed(core.index_root, library, **kw)
+        results["warm_rescan_full_listing"] = {"files": count, "seconds": round(seconds, 4)}
+        core.INCREMENTAL_SCAN = saved[1]
+
+        log("Single queries...")
+        times = []
+        matched = {}
+        for ref in refs[:queries]:
+            found, seconds = timed(query_paths, library, os.path.join(root, ref), **kw)
+            times.append(seconds)
+            matched[ref] = found
+        hit, missed, unexpected = score(root, expected, matched)
+        results["single_query"] = {"queries": len(times), "median_seconds": round(statistics.median(times), 4),
+                                   "max_seconds": round(max(times), 4), "found": hit, "missed": missed,
+                                   "unexpected": unexpected}
+
+        log("Batch query...")
+        grouped, seconds = timed(core.query_batch, library, [os.path.join(root, r) for r in refs], **kw)
+        matched = {os.path.relpath(ref, root): [m["path"] for m in found]
+                   for ref, found in grouped.items() if isinstance(found, list)}
+        hit, missed, unexpected = score(root, expected, matched)
+        results["batch_query"] = {"refs": len(refs), "seconds": round(seconds, 4), "found": hit,
+                                  "missed": missed, "unexpected": unexpected}
+
+        log("Cache Manager load...")
+        conn = core.connect_db()
+        groups, seconds = timed(core.folder_counts, conn)
+        conn.close()
+        results["cache_manager_load"] = {"folders": len(groups), "seconds": round(seconds, 4)}
+    finally:
+        core.DB_NAME, core.INCREMENTAL_SCAN = saved
+
+    log("DB writes...")
+    write_db = os.path.join(root, "bench_writes.db")
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(write_db + suffix):
+            os.remove(write_db + suffix)
+    results["db_write"] = bench_db_writes(write_db, write_rows, manifest["seed"])
+
+    return {
+        "version": git_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "pool": pool_kind,
+        "workers": workers,
+        "corpus": {k: v for k, v in manifest.items() if k != "expected"},
+        "results": results,
+    }
+
+def git_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or "unknown"
+    except Exception:
+        return "unknown"
+
+def compare_reports(old, new):
+    """ Rows of (benchmark, metric, old, new, new / old) for the numeric metrics both reports have. """
+    rows = []
+    for name, metrics in new["results"].items():
+        before = old["results"].get(name, {})
+        for metric, value in metrics.items():
+            if metric in before and isinstance(value, (int, float)) and before[metric]:
+                rows.append((name, metric, before[metric], value, value / before[metric]))
+    return rows
+
+# --- COMMAND LINE ---
+def print_status(kind, data):
+    if kind == "status":
+        print(data, file=sys.stderr)
+
+def cmd_generate(args):
+    start = time.time()
+    try:
+        manifest = generate_corpus(args.root, args.originals, args.seed, args.max_megapixels, force=args.force)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    print(f"{manifest['files']} files, {manifest['bytes'] / (1024 * 1024):.1f} MB in {time.time() - start:.1f}s",
+          file=sys.stderr)
+
+def cmd_run(args):
+    report = run_benchmarks(args.root, args.queries, args.write_rows, args.pool, args.workers, on_status=print_status)
+    text = json.dumps(report, indent=2)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            f.write(text)
+    print(text)
+
+def cmd_compare(args):
+    with open(args.old, encoding="utf-8") as f:
+        old = json.load(f)
+    with open(args.new, encoding="utf-8") as f:
+        new = json.load(f)
+    print(f"{old['version']} -> {new['version']}")
+    for name, metric, before, after, ratio in compare_reports(old, new):
+        print(f"{name:26} {metric:18} {before:>12} {after:>12} {ratio:7.2f}x")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="finder_bench.py", description="SourceSeeker benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("generate", help="write a deterministic synthetic corpus")
+    p.add_argument("root")
+    p.add_argument("--originals", type=int, default=200, help="originals; each adds 3 variants and a reference")
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--max-megapixels", type=float, default=50)
+    p.add_argument("--force", action="store_true", help="delete root first even if it holds no corpus")
+    p.set_defaults(func=cmd_generate)
+
+    p = sub.add_parser("run", help="benchmark scans, queries and the database on a generated corpus")
+    p.add_argument("root")
+    p.add_argument("--report", help="also write the JSON report to this file")
+    p.add_argument("--queries", type=int, default=20, help="single queries to time")
+    p.add_argument("--write-rows", type=int, default=100_000, help="rows for the DB write benchmark")
+    p.add_argument("--pool", choices=("process", "thread"), default=core.HASH_POOL)
+    p.add_argument("--workers", type=int, default=core.HASH_WORKERS)
+    p.set_defaults(func=cmd_run)
+
+    p = sub.add_parser("compare", help="compare two reports, new / old per metric")
+    p.add_argument("old")
+    p.add_argument("new")
+    p.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args) or 0
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,273 @@
+r"""
+Command line interface for SourceSeeker, for scripts and headless machines.
+Only imports the GUI-free core, so it runs without tkinter or a display.
+
+    python finder_cli.py index "D:\My Art Library"
+    python finder_cli.py query "D:\My Art Library" screenshot.png
+    python finder_cli.py query "D:\My Art Library" ffc3c3c381818100 --max-distance 8
+    python finder_cli.py query "D:\My Art Library" screenshot.png --algorithm cascade
+    python finder_cli.py query "D:\My Art Library" screenshot.png --top-k 10 --max-distance 12
+    python finder_cli.py query "D:\My Art Library" screenshot.png --prompt "castle" --max-distance 10
+    python finder_cli.py query "D:\My Art Library" screenshot.png --index-only
+    python finder_cli.py batch "D:\My Art Library" "D:\Screenshots"
+    python finder_cli.py search "D:\My Art Library" --seed 12345
+    python finder_cli.py search --prompt "castle NOT night" --model sdxl
+    python finder_cli.py duplicates "D:\My Art Library"
+    python finder_cli.py clusters "D:\My Art Library" --max-distance 5
+    python finder_cli.py validate-decode "D:\My Art Library" --limit 500
+    python finder_cli.py watch
+    python finder_cli.py serve
+    python finder_cli.py --service http://127.0.0.1:8765 query "D:\My Art Library" screenshot.png
+    python finder_cli.py --stats-log scan_stats.jsonl --profile scan.prof index "D:\My Art Library"
+
+Results are written to stdout as JSON lines; progress goes to stderr with --verbose.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+
+import finder_core as core
+import finder_watch
+import finder_service
+
+
+def print_status(kind, data):
+    if kind == "status":
+        print(data, file=sys.stderr)
+    elif kind == "stats" and data["final"]:
+        print(core.format_stats(data), file=sys.stderr)
+
+def emit(obj):
+    print(json.dumps(obj), flush=True)
+
+def cmd_index(args):
+    start = time.time()
+    if args.service:
+        count = finder_service.ServiceClient(args.service).index(args.folder, args.algorithm)
+        emit({"root": args.folder, "files": count, "seconds": round(time.time() - start, 3)})
+        return
+    count = core.index_root(args.folder, on_status=print_status if args.verbose else None,
+                            pool_kind=args.pool, workers=args.workers, algorithm=args.algorithm,
+                            profile=args.profile)
+    emit({"root": args.folder, "files": count, "seconds": round(time.time() - start, 3)})
+
+def metadata_filter(args):
+    """ The --prompt/--seed/--model options as a search_metadata() filter, or None. """
+    found = {"text": args.prompt, "seed": args.seed, "model": args.model}
+    return {k: v for k, v in found.items() if v is not None} or None
+
+def cmd_query(args):
+    try:
+        if args.service:
+            for res in finder_service.ServiceClient(args.service).query(
+                    args.folder, args.ref, args.max_distance, algorithm=args.algorithm,
+                    top_k=args.top_k, metadata=metadata_filter(args)):
+                emit(res)
+            return
+        for res in core.query(args.folder, args.ref, args.max_distance,
+                              on_status=print_status if args.verbose else None, algorithm=args.algorithm,
+                              top_k=args.top_k, metadata=metadata_filter(args), index_only=args.index_only,
+                              pool_kind=args.pool, workers=args.workers, profile=args.profile):
+            emit(res)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+def expand_refs(refs, refs_file=None):
+    """ Reference arguments plus lines of --refs-file; a folder stands for the images directly inside it. """
+    if refs_file:
+        with open(refs_file, encoding="utf-8") as f:
+            refs = list(refs) + [line.strip() for line in f if line.strip()]
+    out = []
+    for ref in refs:
+        if os.path.isdir(ref):
+            out += sorted(e.path for e in os.scandir(ref) if e.is_file()
+                          and os.path.splitext(e.name)[1].lower() in core.IMAGE_EXTENSIONS)
+        else:
+            out.append(ref)
+    return out
+
+def cmd_batch(args):
+    refs = expand_refs(args.refs, args.refs_file)
+    if not refs:
+        print("Error: no references given", file=sys.stderr)
+        return 1
+    if args.service:
+        grouped = finder_service.ServiceClient(args.service).batch(args.folder, refs, args.max_distance, args.top_k)
+    else:
+        grouped = core.query_batch(args.folder, refs, args.max_distance,
+                                   on_status=print_status if args.verbose else None, top_k=args.top_k,
+                                   index_only=args.index_only, pool_kind=args.pool, workers=args.workers,
+                                   profile=args.profile)
+    failed = 0
+    for ref, results in grouped.items():
+        if isinstance(results, ValueError):
+            failed += 1
+            emit({"ref": ref, "error": str(results)})
+        else:
+            emit({"ref": ref, "matches": results})
+    return 1 if failed == len(grouped) else 0
+
+def cmd_duplicates(args):
+    groups = core.find_exact_duplicates(args.folder, on_status=print_status if args.verbose else None,
+                                        rescan=not args.no_scan, pool_kind=args.pool, workers=args.workers,
+                                        profile=args.profile)
+    for group in groups:
+        emit(group)
+    print(f"{len(groups)} groups, {sum(g['wasted'] for g in groups) / (1024 * 1024):.1f} MB reclaimable",
+          file=sys.stderr)
+
+def cmd_clusters(args):
+    for cluster in core.find_near_duplicates(args.folder, args.max_distance,
+                                             on_status=print_status if args.verbose else None,
+                                             pool_kind=args.pool, workers=args.workers, algorithm=args.algorithm):
+        emit(cluster)
+
+def cmd_search(args):
+    found = metadata_filter(args)
+    if not found:
+        print("Error: give --prompt, --seed and/or --model", file=sys.stderr)
+        return 1
+    conn = core.connect_db()
+    try:
+        for row in core.search_metadata(conn, folder=args.folder, limit=args.limit, **found):
+            emit(row)
+    finally:
+        conn.close()
+
+def add_index_only_option(p):
+    p.add_argument("--index-only", action="store_true",
+                   help="answer from the index without walking the folder; only matches are checked on disk "
+                        "(images added since the last index/watch are not found)")
+
+def add_metadata_options(p):
+    p.add_argument("--prompt", help="FTS5 query over prompt, negative prompt, model and sampler")
+    p.add_argument("--seed", help="exact generation seed")
+    p.add_argument("--model", help="words of the model name")
+
+def cmd_watch(args):
+    conn = core.connect_db()
+    try:
+        for folder in args.folders:
+            core.register_root(conn.cursor(), os.path.abspath(folder))
+        conn.commit()
+    finally:
+        conn.close()
+    watcher = finder_watch.IndexWatcher(on_status=print_status, pool_kind=args.pool,
+                                        workers=args.workers or finder_watch.WATCH_WORKERS,
+                                        use_inotify=not args.poll)
+    finder_watch.lower_priority() # A process of its own: nothing else to slow down
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.stop()
+
+def cmd_serve(args):
+    service = finder_service.QueryService(args.host, args.port, pool_kind=args.pool,
+                                          workers=args.workers, on_status=print_status)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+def cmd_validate_decode(args):
+    print(json.dumps(core.validate_fast_decode(args.folder, args.limit), indent=2))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="finder_cli.py", description="SourceSeeker headless index and search")
+    parser.add_argument("--db", default=core.DB_NAME, help="hash database file (default: %(default)s)")
+    parser.add_argument("--pool", choices=("process", "thread"), default=core.HASH_POOL, help="hashing pool type")
+    parser.add_argument("--workers", type=int, help=f"hashing workers (default: {core.HASH_WORKERS}, "
+                                                      f"{finder_watch.WATCH_WORKERS} for watch)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print progress and a timing summary to stderr")
+    parser.add_argument("--stats-log", help="append scan timing and counter events to this file as JSON lines")
+    parser.add_argument("--profile", help="write a cProfile dump of the scan to this file")
+    parser.add_argument("--service", metavar="URL",
+                        help=f"send index, query and batch to a running 'serve' process, e.g. {finder_service.SERVICE_URL}; "
+                             "queries are then answered from its index only")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("index", help="hash new/changed images under a folder")
+    p.add_argument("folder")
+    p.add_argument("--algorithm", choices=core.QUERY_ALGORITHMS, default="ahash",
+                   help="also backfill the hashes this algorithm needs on older rows")
+    p.set_defaults(func=cmd_index)
+
+    p = sub.add_parser("query", help="find images matching a reference image or hex hash")
+    p.add_argument("folder")
+    p.add_argument("ref", help="image path or hex hash (of --algorithm)")
+    p.add_argument("--max-distance", type=int, default=core.MATCH_DISTANCE)
+    p.add_argument("--algorithm", choices=core.QUERY_ALGORITHMS, default="ahash",
+                   help="hash to compare; cascade = aHash filter, then pHash (default: %(default)s)")
+    p.add_argument("--top-k", type=int, metavar="K",
+                   help="only the K closest matches, by distance then largest file, once the scan is done")
+    add_metadata_options(p)
+    add_index_only_option(p)
+    p.set_defaults(func=cmd_query)
+
+    p = sub.add_parser("batch", help="match many references in a single scan, grouped per reference")
+    p.add_argument("folder")
+    p.add_argument("refs", nargs="*", help="image paths, hex hashes or folders of reference images")
+    p.add_argument("--refs-file", help="file with one reference per line")
+    p.add_argument("--max-distance", type=int, default=core.MATCH_DISTANCE)
+    p.add_argument("--top-k", type=int, metavar="K", help="keep the K closest matches per reference")
+    add_index_only_option(p)
+    p.set_defaults(func=cmd_batch)
+
+    p = sub.add_parser("duplicates", help="group byte-identical images, largest savings first")
+    p.add_argument("folder")
+    p.add_argument("--no-scan", action="store_true", help="use the index as is instead of updating it first")
+    p.set_defaults(func=cmd_duplicates)
+
+    p = sub.add_parser("clusters", help="group near-duplicate images across the index, largest clusters first")
+    p.add_argument("folder", nargs="?", help="only cluster images below this folder (default: whole index)")
+    p.add_argument("--max-distance", type=int, default=core.MATCH_DISTANCE)
+    p.add_argument("--algorithm", choices=list(core.HASH_COLUMNS), default="ahash")
+    p.set_defaults(func=cmd_clusters)
+
+    p = sub.add_parser("search", help="find indexed images by AI generation data, without scanning")
+    p.add_argument("folder", nargs="?", help="only images below this folder (default: whole index)")
+    add_metadata_options(p)
+    p.add_argument("--limit", type=int)
+    p.set_defaults(func=cmd_search)
+
+    p = sub.add_parser("watch", help="keep the index of every scan root up to date in the background until Ctrl+C")
+    p.add_argument("folders", nargs="*", help="scan roots to add before watching")
+    p.add_argument("--poll", action="store_true", help="poll instead of using inotify")
+    p.set_defaults(func=cmd_watch)
+
+    p = sub.add_parser("serve", help="keep the index in memory and answer queries over HTTP on localhost")
+    p.add_argument("--host", default=finder_service.SERVICE_HOST)
+    p.add_argument("--port", type=int, default=finder_service.SERVICE_PORT)
+    p.set_defaults(func=cmd_serve)
+
+    p = sub.add_parser("validate-decode", help="compare fast and full decode hashes")
+    p.add_argument("folder")
+    p.add_argument("--limit", type=int, default=500)
+    p.set_defaults(func=cmd_validate_decode)
+
+    args = parser.parse_args(argv)
+    if getattr(args, "folder", None):
+        # The index stores absolute paths; scan roots and folder prefixes are matched against them
+        args.folder = os.path.abspath(args.folder)
+    if args.workers is None and args.command != "watch":
+        args.workers = core.HASH_WORKERS
+    core.DB_NAME = args.db
+    core.STATS_LOG = args.stats_log
+    core.init_db()
+    if args.service and args.command in ("index", "query", "batch"):
+        try:
+            return args.func(args) or 0
+        except OSError as e:
+            print(f"Error: no query service at {args.service} ({e})", file=sys.stderr)
+        except ValueError as e:
+            print(f"Error: {e}", file=sys.stderr)
+        return 1
+    return args.func(args) or 0
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    sys.exit(main())
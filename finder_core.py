@@ -0,0 +1,2285 @@
+"""
+SourceSeeker core: image hashing, the SQLite hash index and folder scanning.
+Has no GUI dependencies, so scripts and headless machines can use it directly
+(see finder_cli.py); image_finder.py builds the desktop app on top of it.
+"""
+import os
+import io
+import re
+import json
+import zlib
+import struct
+import sqlite3
+import hashlib
+import threading
+import queue
+import time
+import heapq
+import bisect
+import itertools
+import cProfile
+import contextlib
+import collections
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from PIL import Image
+import imagehash
+import numpy as np
+
+# --- CONFIGURATION ---
+DB_NAME = "image_hashes.db"
+
+# Hashing pool: "process" scales with cores, "thread" avoids worker start-up
+# cost and still overlaps well because Pillow releases the GIL while decoding.
+HASH_POOL = "process"
+HASH_WORKERS = max(1, (os.cpu_count() or 2) - 1)
+
+# Reduced-resolution decoding for hashing. aHash only looks at an 8x8 thumbnail,
+# so large images are decoded at (at least) FAST_DECODE_SIZE px instead of full size.
+# Hashes stay within FAST_DECODE_TOLERANCE bits of a full decode (see finder_cli.py validate-decode).
+FAST_DECODE = True
+FAST_DECODE_SIZE = 256
+FAST_DECODE_TOLERANCE = 2
+
+# SQLite tuning. WAL lets the Cache Manager and other readers work while a scan
+# writes; synchronous=NORMAL is crash-safe under WAL (only the last commits can be lost).
+DB_SYNCHRONOUS = "NORMAL"
+DB_CACHE_KB = 64 * 1024
+DB_MMAP_BYTES = 256 * 1024 * 1024
+
+# Hamming distance (out of 64 bits) at which a file counts as a match
+MATCH_DISTANCE = 5
+
+# Perceptual hashes computed from each decode (all from the same decoded image).
+# aHash is always stored in p_hash; the others get their own column. Rows missing a
+# hash that a query needs are rehashed during that query's scan (lazy backfill).
+# Also available: "whash" (about 4x the cost of the others) and "colorhash".
+HASH_ALGORITHMS = ("ahash", "phash", "dhash")
+HASH_COLUMNS = {"ahash": "p_hash", "phash": "dct_hash", "dhash": "diff_hash",
+                "whash": "wavelet_hash", "colorhash": "color_hash"}
+HASHERS = {"ahash": imagehash.average_hash, "phash": imagehash.phash, "dhash": imagehash.dhash,
+           "whash": imagehash.whash, "colorhash": imagehash.colorhash}
+
+# "cascade" queries keep files within CASCADE_AHASH_DISTANCE on the indexed aHash,
+# then confirm them with pHash against the match distance.
+CASCADE_AHASH_DISTANCE = 10
+QUERY_ALGORITHMS = tuple(HASH_COLUMNS) + ("cascade",)
+
+# Batch queries with up to this many references run one HashIndex lookup per
+# reference; larger batches load the root's hashes once and match them all in memory.
+BATCH_INDEX_QUERIES = 8
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.bmp', '.webp', '.tiff'}
+
+# Rescans skip listing and stat-ing directories whose mtime is unchanged since the
+# last completed scan, reusing their cached file list. Files edited in place (which
+# doesn't touch the directory mtime) are only picked up once their directory changes.
+INCREMENTAL_SCAN = True
+
+# A new file whose size and mtime equal those of an indexed file that no longer exists
+# takes over that row's hash instead of being decoded, so moved and renamed images cost
+# a stat rather than a rehash. The row must have the same inode and device, or else a
+# stored partial_hash() that matches the new file; without one the file is rehashed.
+DETECT_MOVES = True
+
+# Exact duplicates: files of equal size are compared by a hash of their first and
+# last PARTIAL_HASH_BYTES, and only files that still collide are read in full.
+PARTIAL_HASH_BYTES = 4096
+DIGEST_CHUNK_BYTES = 1024 * 1024
+
+# Near-duplicate clustering: distinct hashes are matched against each other in jobs
+# of CLUSTER_JOB_HASHES, each expanding at most MAX_CANDIDATE_PAIRS candidate pairs at once.
+CLUSTER_JOB_HASHES = 4096
+MAX_CANDIDATE_PAIRS = 4_000_000
+
+# MemoryIndex keeps the HashArrays of the MEMORY_INDEX_ARRAYS (folder, algorithm) pairs
+# queried last; each is a copy of that folder's paths and hashes.
+MEMORY_INDEX_ARRAYS = 8
+
+# Scan statistics (ScanStats) go to on_status("stats", dict) every STATS_INTERVAL seconds
+# and once more at the end. With STATS_LOG set to a file path, every such event is also
+# appended to it as a JSON line.
+STATS_INTERVAL = 1.0
+STATS_LOG = None
+
+# AI generation data (Automatic1111 "parameters", ComfyUI "prompt") is read from files
+# when they are hashed and kept in an FTS5 index (see search_metadata).
+# Rows indexed before this existed are read once, headers only, at the end of a scan.
+METADATA_INDEX = True
+
+# read_image_text() takes PNG text chunks and JPEG/WebP EXIF and XMP straight from the
+# file, seeking past pixel data. Chunks larger than METADATA_MAX_CHUNK are left out.
+METADATA_MAX_CHUNK = 32 * 1024 * 1024
+
+def reduce_for_hash(img, size=FAST_DECODE_SIZE, mode="L"):
+    """
+    Returns a decoded image no smaller than `size` on its short edge, avoiding full decodes:
+    - JPEG: DCT scaling via draft() (1/2, 1/4 or 1/8 size, luma only unless mode is "RGB")
+    - TIFF: smallest embedded reduced-resolution page with the same aspect ratio
+    - Others: full decode, then a cheap box reduce() before aHash's Lanczos resize
+    """
+    if img.format == "JPEG":
+        img.draft(mode, (size, size))
+    elif img.format == "TIFF" and getattr(img, "n_frames", 1) > 1:
+        w, h = img.size
+        best = None
+        for i in range(img.n_frames):
+            img.seek(i)
+            fw, fh = img.size
+            if min(fw, fh) >= size and abs(fw * h - fh * w) <= max(w, h) and (best is None or fw < best[1]):
+                best = (i, fw)
+        img.seek(best[0] if best else 0)
+
+    factor = min(img.size) // size
+    if factor >= 2:
+        return img.reduce(factor)
+    return img
+
+def calculate_hash(image_path, fast=FAST_DECODE):
+    # Average Hash (aHash) - Best for finding sources/screenshots
+    hashes = calculate_hashes(image_path, ("ahash",), fast)
+    return hashes["ahash"] if hashes else None
+
+class CountingFile(io.FileIO):
+    """ File that counts the bytes actually read, which fast decode keeps below the file size. """
+    bytes_read = 0
+
+    def readinto(self, b):
+        n = super().readinto(b)
+        self.bytes_read += n or 0
+        return n
+
+def calculate_hashes(image_path, algorithms=HASH_ALGORITHMS, fast=FAST_DECODE, timings=None, text=None):
+    """
+    {algorithm: hex hash} for every algorithm, from a single decode. None if unreadable.
+    A `timings` dict receives "decode" and "hash" as (wall, cpu) seconds and "bytes" read,
+    a `text` dict the image's metadata text (see image_info_text).
+    """
+    try:
+        start, start_cpu = time.perf_counter(), time.thread_time()
+        with CountingFile(image_path) as raw, Image.open(io.BufferedReader(raw)) as src:
+            img = src
+            if fast:
+                img = reduce_for_hash(img, mode="RGB" if "colorhash" in algorithms else "L")
+            img.load()
+            if text is not None:
+                text.update(image_info_text(src)) # PNG chunks after the pixel data are only in info after load()
+            gray = img.convert("L") if img.mode != "L" else img
+            decoded, decoded_cpu = time.perf_counter(), time.thread_time()
+            if timings is not None:
+                timings["decode"] = (decoded - start, decoded_cpu - start_cpu)
+                timings["bytes"] = raw.bytes_read
+            hashes = {alg: str(HASHERS[alg](img if alg == "colorhash" else gray)) for alg in algorithms}
+            if timings is not None:
+                timings["hash"] = (time.perf_counter() - decoded, time.thread_time() - decoded_cpu)
+            return hashes
+    except Exception:
+        return None
+
+def parse_a1111(text):
+    """ Fields of an Automatic1111 "parameters" text: prompt, "Negative prompt: ...", then the settings line. """
+    lines = text.strip().split("\n")
+    settings = ""
+    if lines and re.search(r"(^|, )Steps: ", lines[-1]):
+        settings = lines.pop()
+    prompt, negative = [], []
+    for line in lines:
+        if line.startswith("Negative prompt:"):
+            negative.append(line[len("Negative prompt:"):].strip())
+        elif negative:
+            negative.append(line)
+        else:
+            prompt.append(line)
+    fields = {k.strip(): v.strip().strip('"') for k, v in re.findall(r'([\w ]+):\s*("(?:[^"\\]|\\.)*"|[^,]*)', settings)}
+    return {
+        "source": "a1111",
+        "prompt": "\n".join(prompt).strip(),
+        "negative": "\n".join(negative).strip(),
+        "seed": fields.get("Seed"),
+        "steps": fields.get("Steps"),
+        "model": fields.get("Model") or fields.get("Model hash"),
+        "sampler": fields.get("Sampler"),
+    }
+
+def parse_comfyui(graph):
+    """ Fields of a ComfyUI "prompt" graph: the first sampler node, its linked prompts and the checkpoint. """
+    def text_of(link):
+        node = graph.get(str(link[0])) if isinstance(link, list) and link else None
+        text = node and node.get("inputs", {}).get("text")
+        return text if isinstance(text, str) else None
+
+    out = {"source": "comfyui", "prompt": None, "negative": None, "seed": None, "steps": None,
+           "model": None, "sampler": None}
+    texts = []
+    for node in graph.values():
+        inputs = node.get("inputs", {}) if isinstance(node, dict) else {}
+        if isinstance(inputs.get("text"), str):
+            texts.append(inputs["text"])
+        if out["model"] is None:
+            model = inputs.get("ckpt_name") or inputs.get("unet_name")
+            if isinstance(model, str):
+                out["model"] = model
+        if out["seed"] is None:
+            seed = inputs.get("seed", inputs.get("noise_seed"))
+            if isinstance(seed, (int, str)):
+                out["seed"] = seed
+                out["steps"] = inputs.get("steps") if isinstance(inputs.get("steps"), int) else None
+                out["sampler"] = inputs.get("sampler_name") if isinstance(inputs.get("sampler_name"), str) else None
+                out["prompt"] = text_of(inputs.get("positive"))
+                out["negative"] = text_of(inputs.get("negative"))
+    if out["prompt"] is None and texts:
+        out["prompt"] = "\n".join(texts)
+    return out
+
+def parse_generation_info(info):
+    """
+    AI generation data from an image's text chunks (img.info): Automatic1111 "parameters"
+    or a ComfyUI "prompt" graph. Returns {"source", "prompt", "negative", "seed", "steps",
+    "model", "sampler"} with None for missing fields, or None if there is none.
+    """
+    try:
+        if isinstance(info.get("parameters"), str):
+            out = parse_a1111(info["parameters"])
+        elif isinstance(info.get("prompt"), str):
+            graph = json.loads(info["prompt"])
+            if not isinstance(graph, dict):
+                return None
+            out = parse_comfyui(graph)
+        else:
+            return None
+    except Exception:
+        return None
+    # Seeds can exceed SQLite's 64-bit INTEGER, so they are kept as decimal text
+    out["seed"] = str(out["seed"]) if out["seed"] is not None else None
+    try:
+        out["steps"] = int(out["steps"]) if out["steps"] is not None else None
+    except ValueError:
+        out["steps"] = None
+    return out
+
+def decode_png_text(kind, data):
+    """ (key, text) of a PNG tEXt, zTXt or iTXt chunk. """
+    key, _, rest = data.partition(b"\0")
+    if kind == b"tEXt":
+        return key.decode("latin-1"), rest.decode("latin-1")
+    if kind == b"zTXt":
+        return key.decode("latin-1"), zlib.decompressobj().decompress(rest[1:], METADATA_MAX_CHUNK).decode("latin-1")
+    compressed = rest[:1] == b"\1"
+    _, _, rest = rest[2:].partition(b"\0") # language tag
+    _, _, text = rest.partition(b"\0") # translated keyword
+    if compressed:
+        text = zlib.decompressobj().decompress(text, METADATA_MAX_CHUNK)
+    return key.decode("latin-1"), text.decode("utf-8", "replace")
+
+def read_exact(f, length):
+    data = f.read(length)
+    if len(data) < length:
+        raise ValueError("truncated file")
+    return data
+
+def read_png_text(f):
+    text, size = {}, None
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            break
+        length, kind = struct.unpack(">I4s", head)
+        if kind == b"IHDR":
+            size = struct.unpack(">II", read_exact(f, 8))
+            f.seek(length - 8 + 4, 1)
+        elif kind in (b"tEXt", b"zTXt", b"iTXt") and length <= METADATA_MAX_CHUNK:
+            key, value = decode_png_text(kind, read_exact(f, length))
+            text.setdefault(key, value)
+            f.seek(4, 1)
+        elif kind == b"IEND":
+            break
+        else:
+            f.seek(length + 4, 1) # Pixel data and everything else: skipped, not read
+    return "PNG", size, text
+
+def exif_text(data):
+    """ Text fields of an EXIF block: UserComment (Automatic1111 writes its "parameters" there) and ImageDescription. """
+    exif = Image.Exif()
+    exif.load(data)
+    text = {}
+    comment = exif.get_ifd(0x8769).get(0x9286)
+    if isinstance(comment, bytes):
+        prefix, body = comment[:8], comment[8:]
+        if prefix.startswith(b"UNICODE"):
+            tiff = data[6:] if data.startswith(b"Exif") else data
+            comment = body.decode("utf-16-be" if tiff[:2] == b"MM" else "utf-16-le", "replace")
+        else:
+            comment = body.decode("utf-8", "replace")
+    if isinstance(comment, str) and comment.strip("\0 "):
+        comment = comment.strip("\0")
+        text["parameters" if "Steps: " in comment else "UserComment"] = comment
+    description = exif.get(0x010E)
+    if isinstance(description, str) and description.strip("\0 "):
+        text["ImageDescription"] = description.strip("\0")
+    return text
+
+def read_jpeg_text(f):
+    text, size = {}, None
+    while True:
+        byte = f.read(1)
+        if not byte:
+            break
+        if byte != b"\xff":
+            continue
+        marker = f.read(1)
+        while marker == b"\xff":
+            marker = f.read(1)
+        if not marker:
+            break
+        m = marker[0]
+        if m in (0x01, 0xD8) or 0xD0 <= m <= 0xD7:
+            continue
+        if m in (0xD9, 0xDA): # End of image / start of scan: no metadata after this
+            break
+        length = struct.unpack(">H", f.read(2))[0] - 2
+        if m == 0xE1 or m == 0xFE or (0xC0 <= m <= 0xCF and m not in (0xC4, 0xC8, 0xCC)):
+            data = read_exact(f, length)
+            if m == 0xFE:
+                text.setdefault("comment", data.decode("utf-8", "replace"))
+            elif m != 0xE1:
+                size = struct.unpack(">HH", data[1:5])[::-1]
+            elif data.startswith(b"Exif\0\0"):
+                text.update(exif_text(data))
+            elif data.startswith(b"http://ns.adobe.com/xap/1.0/\0"):
+                text["XMP"] = data.split(b"\0", 1)[1].decode("utf-8", "replace")
+        else:
+            f.seek(length, 1)
+    return "JPEG", size, text
+
+def read_webp_text(f):
+    text, size = {}, None
+    while True:
+        head = f.read(8)
+        if len(head) < 8:
+            break
+        kind, length = struct.unpack("<4sI", head)
+        padded = length + (length & 1)
+        if kind == b"VP8X":
+            data = f.read(padded)
+            size = (1 + int.from_bytes(data[4:7], "little"), 1 + int.from_bytes(data[7:10], "little"))
+        elif kind == b"VP8 " and size is None:
+            data = f.read(10)
+            size = (struct.unpack("<H", data[6:8])[0] & 0x3FFF, struct.unpack("<H", data[8:10])[0] & 0x3FFF)
+            f.seek(padded - 10, 1)
+        elif kind == b"VP8L" and size is None:
+            bits = struct.unpack("<I", f.read(5)[1:])[0]
+            size = (1 + (bits & 0x3FFF), 1 + ((bits >> 14) & 0x3FFF))
+            f.seek(padded - 5, 1)
+        elif kind == b"EXIF" and length <= METADATA_MAX_CHUNK:
+            text.update(exif_text(read_exact(f, length)))
+            f.seek(padded - length, 1)
+        elif kind == b"XMP " and length <= METADATA_MAX_CHUNK:
+            text["XMP"] = read_exact(f, length).decode("utf-8", "replace")
+            f.seek(padded - length, 1)
+        else:
+            f.seek(padded, 1)
+    return "WEBP", size, text
+
+def read_image_text(path):
+    """
+    (format, (width, height) or None, {key: text}) from a file's metadata alone: PNG text chunks,
+    JPEG/WebP EXIF comments, XMP and JPEG comments, without touching pixel data.
+    Other formats go through Pillow's header parsing. Raises OSError/ValueError if unreadable.
+    """
+    with open(path, "rb") as f:
+        head = f.read(12)
+        try:
+            if head[:8] == b"\x89PNG\r\n\x1a\n":
+                f.seek(8)
+                return read_png_text(f)
+            if head[:2] == b"\xff\xd8":
+                f.seek(2)
+                return read_jpeg_text(f)
+            if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+                return read_webp_text(f)
+        except (struct.error, zlib.error, IndexError, SyntaxError) as e:
+            raise ValueError(f"Damaged metadata in {path}: {e}")
+    with Image.open(path) as img:
+        return img.format, img.size, {k: v for k, v in img.info.items() if isinstance(v, str)}
+
+def image_info_text(img):
+    """ {key: text} of an opened image as Pillow parsed it: text chunks, plus the EXIF comments of JPEG/WebP. """
+    text = {k: v for k, v in img.info.items() if isinstance(v, str)}
+    if isinstance(img.info.get("exif"), bytes):
+        try:
+            text.update(exif_text(img.info["exif"]))
+        except Exception:
+            pass
+    return text
+
+def read_generation_info(path):
+    """ parse_generation_info() of a file's metadata, without decoding pixels. {} if it has none, None if unreadable. """
+    try:
+        return parse_generation_info(read_image_text(path)[2]) or {}
+    except Exception:
+        return None
+
+def metadata_job(path):
+    """ Pool worker for the metadata backfill: path -> (path, read_generation_info(path)). """
+    return path, read_generation_info(path)
+
+def query_algorithms(algorithm):
+    """ The hashes a query with `algorithm` (one of QUERY_ALGORITHMS) compares. """
+    if algorithm not in QUERY_ALGORITHMS:
+        raise ValueError(f"Unknown algorithm: {algorithm}")
+    return ("ahash", "phash") if algorithm == "cascade" else (algorithm,)
+
+def validate_fast_decode(folder, limit=500):
+    """
+    Compares fast and full decodes on up to `limit` images under `folder`.
+    Returns a report dict with the Hamming distance histogram and CPU time of both paths.
+    """
+    report = {"folder": folder, "files": 0, "failed": 0, "tolerance": FAST_DECODE_TOLERANCE,
+              "histogram": {}, "max_distance": 0, "over_tolerance": [],
+              "full_cpu_s": 0.0, "fast_cpu_s": 0.0}
+
+    for root, dirs, files in os.walk(folder):
+        for file in files:
+            if report["files"] >= limit: break
+            if os.path.splitext(file)[1].lower() not in IMAGE_EXTENSIONS: continue
+            path = os.path.join(root, file)
+
+            t0 = time.process_time()
+            full = calculate_hash(path, fast=False)
+            t1 = time.process_time()
+            fast = calculate_hash(path, fast=True)
+            t2 = time.process_time()
+            if not full or not fast:
+                report["failed"] += 1
+                continue
+
+            dist = int(imagehash.hex_to_hash(full) - imagehash.hex_to_hash(fast))
+            report["files"] += 1
+            report["full_cpu_s"] += t1 - t0
+            report["fast_cpu_s"] += t2 - t1
+            report["histogram"][dist] = report["histogram"].get(dist, 0) + 1
+            report["max_distance"] = max(report["max_distance"], dist)
+            if dist > FAST_DECODE_TOLERANCE:
+                report["over_tolerance"].append({"path": path, "distance": dist})
+
+    if report["fast_cpu_s"] > 0:
+        report["speedup"] = round(report["full_cpu_s"] / report["fast_cpu_s"], 2)
+    report["histogram"] = {str(k): v for k, v in sorted(report["histogram"].items())}
+    return report
+
+def file_info(entry):
+    """ (size, inode, dev) of a DirEntry. DirEntry.inode() is also filled in on Windows, where stat() leaves st_ino 0. """
+    st = entry.stat()
+    return st.st_size, entry.inode(), st.st_dev
+
+def partial_hash(path, size):
+    """
+    SHA-256 of the first and last PARTIAL_HASH_BYTES of a file. Files that fit in
+    those two blocks are read whole, and the result is then their full digest.
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        if size <= 2 * PARTIAL_HASH_BYTES:
+            h.update(f.read())
+        else:
+            h.update(f.read(PARTIAL_HASH_BYTES))
+            f.seek(-PARTIAL_HASH_BYTES, os.SEEK_END)
+            h.update(f.read(PARTIAL_HASH_BYTES))
+    return h.hexdigest()
+
+def content_digest(path):
+    """ SHA-256 of the whole file, read in DIGEST_CHUNK_BYTES blocks. """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(DIGEST_CHUNK_BYTES):
+            h.update(chunk)
+    return h.hexdigest()
+
+def hash_job(job):
+    """
+    Pool worker: (path, mtime, algorithms) ->
+    (path, mtime, {algorithm: integer hash} or None, timings, generation info or None).
+    Must stay top-level to be picklable.
+    """
+    path, mtime, algorithms = job
+    timings, text = {}, {}
+    hashes = calculate_hashes(path, algorithms, timings=timings, text=text if METADATA_INDEX else None)
+    # Taken from the decode's own header parsing: the file isn't opened a second time
+    generation = (parse_generation_info(text) or {}) if hashes and METADATA_INDEX else None
+    return path, mtime, hashes and {alg: hash_to_int(h) for alg, h in hashes.items()}, timings, generation
+
+def make_hash_pool(kind=HASH_POOL, workers=HASH_WORKERS, initializer=None):
+    if kind == "thread":
+        return ThreadPoolExecutor(max_workers=workers, initializer=initializer)
+    return ProcessPoolExecutor(max_workers=workers, initializer=initializer)
+
+MASK64 = (1 << 64) - 1
+_POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+def hash_to_int(hex_hash):
+    """ Hex aHash -> signed 64-bit int, the form stored in files.p_hash (SQLite INTEGER is signed) """
+    v = int(hex_hash, 16)
+    return v - (1 << 64) if v >= (1 << 63) else v
+
+def int_to_hash(value):
+    """ Stored p_hash -> 16-char hex aHash """
+    return f"{value & MASK64:016x}"
+
+def hamming(hash_a, hash_b):
+    """ Bit distance between two integer aHashes. """
+    return bin((hash_a ^ hash_b) & MASK64).count("1")
+
+def popcount64(arr):
+    """ Vectorized popcount of a uint64 array. """
+    if hasattr(np, "bitwise_count"): # NumPy 2.0+
+        return np.bitwise_count(arr)
+    return _POPCOUNT8[arr.view(np.uint8)].reshape(-1, 8).sum(axis=1, dtype=np.uint8)
+
+def hash_chunks(value):
+    """ Splits an integer aHash into the four 16-bit substrings stored as files.h0..h3 """
+    return tuple((value >> (48 - 16 * k)) & 0xFFFF for k in range(4))
+
+def subtree_range(folder):
+    """
+    (lo, hi) bounds such that `lo <= path < hi` selects every path below `folder`.
+    Lets SQLite answer subtree queries with a primary key range scan instead of LIKE.
+    """
+    prefix = folder if folder.endswith(('/', '\\')) else folder + os.sep
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def connect_db():
+    """ Opens a connection with the tuned pragmas. Each thread/window uses its own. """
+    conn = sqlite3.connect(DB_NAME, timeout=30)
+    conn.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA cache_size = -{DB_CACHE_KB}")
+    conn.execute(f"PRAGMA mmap_size = {DB_MMAP_BYTES}")
+    return conn
+
+FILES_SCHEMA = '''(path TEXT PRIMARY KEY, mtime REAL, p_hash INTEGER,
+                  h0 INTEGER, h1 INTEGER, h2 INTEGER, h3 INTEGER, dir_id INTEGER,
+                  size INTEGER, inode INTEGER, dev INTEGER, partial_hash TEXT, digest TEXT,
+                  dct_hash INTEGER, diff_hash INTEGER, wavelet_hash INTEGER, color_hash INTEGER,
+                  meta_read INTEGER)'''
+# Columns every index row read by the scanner carries, after path and mtime
+EXTRA_HASH_COLUMNS = [col for alg, col in HASH_COLUMNS.items() if alg != "ahash"]
+
+def init_db():
+    global METADATA_INDEX
+    conn = connect_db()
+    c = conn.cursor()
+    c.execute("PRAGMA journal_mode = WAL") # Persistent: stored in the database file
+    # File hashes table (p_hash = signed 64-bit aHash, h0..h3 = its 16-bit substrings for the HashIndex)
+    c.execute(f"CREATE TABLE IF NOT EXISTS files {FILES_SCHEMA}")
+    # Roots table to track scan sessions for grouping
+    c.execute('''CREATE TABLE IF NOT EXISTS scan_roots 
+                 (id INTEGER PRIMARY KEY, path TEXT UNIQUE)''')
+    # Directory tree; root_id = deepest scan root containing the directory,
+    # mtime/entry_count = state at the last completed listing (NULL = must relist)
+    c.execute('''CREATE TABLE IF NOT EXISTS directories 
+                 (id INTEGER PRIMARY KEY, path TEXT UNIQUE, parent_id INTEGER, root_id INTEGER,
+                  mtime REAL, entry_count INTEGER)''')
+    dir_cols = {r[1] for r in c.execute("PRAGMA table_info(directories)")}
+    if "mtime" not in dir_cols:
+        c.execute("ALTER TABLE directories ADD COLUMN mtime REAL")
+        c.execute("ALTER TABLE directories ADD COLUMN entry_count INTEGER")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_directories_root ON directories (root_id)")
+
+    # Migrate databases that still store hex TEXT hashes: rebuild the table in place
+    p_hash_type = {r[1]: r[2] for r in c.execute("PRAGMA table_info(files)")}.get("p_hash")
+    if p_hash_type != "INTEGER":
+        conn.create_function("hex_to_int64", 1, lambda h: hash_to_int(h) if h else None)
+        c.execute(f"CREATE TABLE files_new {FILES_SCHEMA}")
+        c.execute("INSERT INTO files_new (path, mtime, p_hash) SELECT path, mtime, hex_to_int64(p_hash) FROM files")
+        c.execute('''UPDATE files_new SET h0 = (p_hash >> 48) & 65535, h1 = (p_hash >> 32) & 65535,
+                                         h2 = (p_hash >> 16) & 65535, h3 = p_hash & 65535''')
+        c.execute("DROP TABLE files")
+        c.execute("ALTER TABLE files_new RENAME TO files")
+    file_cols = {r[1] for r in c.execute("PRAGMA table_info(files)")}
+    if "dir_id" not in file_cols:
+        c.execute("ALTER TABLE files ADD COLUMN dir_id INTEGER")
+    # File identity for move detection; NULL on old rows until their directory is relisted
+    for col in ("size", "inode", "dev"):
+        if col not in file_cols:
+            c.execute(f"ALTER TABLE files ADD COLUMN {col} INTEGER")
+    # Content hashes for exact duplicates (see find_exact_duplicates); cleared whenever the row is rewritten
+    for col in ("partial_hash", "digest"):
+        if col not in file_cols:
+            c.execute(f"ALTER TABLE files ADD COLUMN {col} TEXT")
+    # Other perceptual hashes; NULL until a file is (re)hashed with them
+    for col in EXTRA_HASH_COLUMNS:
+        if col not in file_cols:
+            c.execute(f"ALTER TABLE files ADD COLUMN {col} INTEGER")
+    # 1 once the file's generation info has been read into the metadata tables
+    if "meta_read" not in file_cols:
+        c.execute("ALTER TABLE files ADD COLUMN meta_read INTEGER")
+    for k in range(4):
+        c.execute(f"CREATE INDEX IF NOT EXISTS idx_files_h{k} ON files (h{k})")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_files_dir ON files (dir_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_files_size ON files (size, mtime)")
+
+    # AI generation data: structured fields in metadata, text in metadata_fts (rowid = metadata.id).
+    # Triggers drop both when the file's row goes, however it is deleted.
+    c.execute('''CREATE TABLE IF NOT EXISTS metadata
+                 (id INTEGER PRIMARY KEY, path TEXT UNIQUE, source TEXT, seed TEXT, steps INTEGER,
+                  model TEXT, sampler TEXT)''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_metadata_seed ON metadata (seed)")
+    try:
+        c.execute("CREATE VIRTUAL TABLE IF NOT EXISTS metadata_fts USING fts5 (prompt, negative, model, sampler)")
+        c.execute('''CREATE TRIGGER IF NOT EXISTS metadata_delete AFTER DELETE ON metadata
+                     BEGIN DELETE FROM metadata_fts WHERE rowid = old.id; END''')
+        c.execute('''CREATE TRIGGER IF NOT EXISTS files_delete_metadata AFTER DELETE ON files
+                     BEGIN DELETE FROM metadata WHERE path = old.path; END''')
+    except sqlite3.OperationalError as e:
+        METADATA_INDEX = False
+        print(f"Metadata index disabled (SQLite without FTS5?): {e}")
+
+    # Migrate scan_roots without a stable id column (rowids may change on VACUUM)
+    if "id" not in {r[1] for r in c.execute("PRAGMA table_info(scan_roots)")}:
+        c.execute("ALTER TABLE scan_roots RENAME TO scan_roots_old")
+        c.execute("CREATE TABLE scan_roots (id INTEGER PRIMARY KEY, path TEXT UNIQUE)")
+        c.execute("INSERT INTO scan_roots (path) SELECT path FROM scan_roots_old")
+        c.execute("DROP TABLE scan_roots_old")
+
+    # Backfill directory ids for rows written before the directories table existed
+    orphans = c.execute("SELECT path FROM files WHERE dir_id IS NULL").fetchall()
+    if orphans:
+        dirs = DirectoryIndex(c)
+        c.executemany("UPDATE files SET dir_id = ? WHERE path = ?",
+                      [(dirs.get(os.path.dirname(r[0])), r[0]) for r in orphans])
+    conn.commit()
+    conn.close()
+
+class ScanStats:
+    """
+    Wall and CPU time per phase plus counters for one scan; safe to update from any thread.
+    Phases: walk (listing, stat), index_read (cached rows, move lookups), decode and hash
+    (timed inside the pool workers), prune, write (SQLite flush and commit), match, and
+    thumbnail for front ends that build them. Phases overlap across threads and workers,
+    so their times are totals of work done, not shares of the elapsed time.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.phases = {} # name -> [wall, cpu, count]
+        self.counters = collections.Counter()
+        self.failures = collections.Counter() # extension -> unreadable files
+        self.max_commit = 0.0
+
+    def add(self, phase, wall, cpu=0.0, count=1):
+        with self.lock:
+            totals = self.phases.setdefault(phase, [0.0, 0.0, 0])
+            totals[0] += wall
+            totals[1] += cpu
+            totals[2] += count
+            if phase == "write":
+                self.max_commit = max(self.max_commit, wall)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def failed(self, path):
+        with self.lock:
+            self.failures[os.path.splitext(path)[1].lower()] += 1
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start, start_cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, time.thread_time() - start_cpu)
+
+    def add_job(self, timings):
+        """ Records the timings dict of a hash_job. """
+        for phase in ("decode", "hash"):
+            if phase in timings:
+                self.add(phase, *timings[phase])
+        self.count("bytes_read", timings.get("bytes", 0))
+
+    def snapshot(self):
+        """ JSON-ready dict of everything so far. """
+        with self.lock:
+            elapsed = time.perf_counter() - self.start
+            files = sum(self.counters[k] for k in ("hit", "reused", "hashed", "unreadable", "failed"))
+            writes = self.phases.get("write", [0.0, 0.0, 0])
+            return {
+                "elapsed": round(elapsed, 3),
+                "cpu": round(time.process_time() - self.start_cpu, 3),
+                "files": files,
+                "files_per_second": round(files / elapsed, 1) if elapsed else 0.0,
+                "cache_hit_rate": round((self.counters["hit"] + self.counters["reused"]) / files, 3) if files else 0.0,
+                "counters": dict(self.counters),
+                "decode_failures": dict(self.failures),
+                "phases": {name: {"wall": round(w, 4), "cpu": round(c, 4), "count": n}
+                           for name, (w, c, n) in self.phases.items()},
+                "commits": {"count": writes[2], "mean": round(writes[0] / writes[2], 4) if writes[2] else 0.0,
+                            "max": round(self.max_commit, 4)},
+            }
+
+def format_stats(stats):
+    """ One status-bar line from a ScanStats snapshot. """
+    phases = stats["phases"]
+    busiest = sorted(phases, key=lambda name: -phases[name]["wall"])[:4]
+    text = (f"{stats['files_per_second']:.0f} files/s, {stats['cache_hit_rate']:.0%} cached, "
+            f"{stats['counters'].get('bytes_read', 0) / (1024 * 1024):.1f} MB read")
+    if busiest:
+        text += " | " + ", ".join(f"{name} {phases[name]['wall']:.1f}s" for name in busiest)
+    failures = sum(stats["decode_failures"].values())
+    if failures:
+        text += f" | {failures} unreadable"
+    return text
+
+class IndexWriter:
+    """
+    The single writer for hash rows. Rows are buffered and flushed with one
+    executemany per transaction, every BATCH_SIZE rows or FLUSH_SECONDS,
+    so the write lock is only held briefly. Other writes made on `conn`
+    (directories, pruning) are committed with the same flush.
+    Rewriting a row with an unchanged mtime keeps the values it isn't given
+    (other hashes, content digests, metadata state); a new mtime clears them.
+    """
+    KEPT_COLUMNS = ["size", "inode", "dev", "partial_hash", "digest"] + EXTRA_HASH_COLUMNS + ["meta_read"]
+    BATCH_SIZE = 2000
+    FLUSH_SECONDS = 2.0
+
+    def __init__(self, conn=None, stats=None):
+        self.conn = conn or connect_db()
+        self.rows = []
+        self.metadata = [] # (path, generation info)
+        self.last_flush = time.time()
+        self.stats = stats or ScanStats()
+
+    def add(self, path, mtime, hashes, dir_id=None, info=None, generation=None):
+        """
+        `hashes` is {algorithm: integer hash} and must include "ahash"; `info` the file's (size, inode, dev),
+        if known; `generation` its parse_generation_info() fields ({} for none) if they were read.
+        """
+        value = hashes["ahash"]
+        self.rows.append((path, mtime, value) + hash_chunks(value) + (dir_id,) + (info or (None, None, None))
+                         + (None, None) + tuple(hashes.get(alg) for alg in HASH_COLUMNS if alg != "ahash") + (None,))
+        if generation is not None:
+            self.metadata.append((path, generation))
+        self.maybe_flush()
+
+    def add_metadata(self, path, generation):
+        """ Replaces the generation info of an already indexed file and marks it read. """
+        self.metadata.append((path, generation))
+        if len(self.metadata) >= self.BATCH_SIZE:
+            self.flush()
+
+    def maybe_flush(self):
+        """
+        Call after direct writes on `conn` too, and regularly while no rows come in (cache hits,
+        idle waits): their transaction holds the write lock until the next flush.
+        """
+        if len(self.rows) >= self.BATCH_SIZE or (time.time() - self.last_flush >= self.FLUSH_SECONDS and
+                                                 (self.rows or self.metadata or self.conn.in_transaction)):
+            self.flush()
+
+    def flush(self):
+        with self.stats.phase("write"):
+            self.write_rows()
+        self.last_flush = time.time()
+
+    def write_rows(self):
+        if self.rows:
+            kept = ", ".join(f"{col} = COALESCE(excluded.{col}, CASE WHEN files.mtime = excluded.mtime "
+                             f"THEN files.{col} END)" for col in self.KEPT_COLUMNS)
+            self.conn.executemany(
+                f"INSERT INTO files (path, mtime, p_hash, h0, h1, h2, h3, dir_id, {', '.join(self.KEPT_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * (8 + len(self.KEPT_COLUMNS)))}) "
+                "ON CONFLICT (path) DO UPDATE SET mtime = excluded.mtime, p_hash = excluded.p_hash, "
+                "h0 = excluded.h0, h1 = excluded.h1, h2 = excluded.h2, h3 = excluded.h3, "
+                f"dir_id = excluded.dir_id, {kept}", self.rows)
+            self.stats.count("rows_written", len(self.rows))
+            self.rows = []
+        if self.metadata and METADATA_INDEX:
+            c = self.conn.cursor()
+            c.executemany("DELETE FROM metadata WHERE path = ?", [(p,) for p, g in self.metadata])
+            c.executemany("UPDATE files SET meta_read = 1 WHERE path = ?", [(p,) for p, g in self.metadata])
+            for path, g in self.metadata:
+                if g:
+                    c.execute("INSERT INTO metadata (path, source, seed, steps, model, sampler) VALUES (?, ?, ?, ?, ?, ?)",
+                              (path, g["source"], g["seed"], g["steps"], g["model"], g["sampler"]))
+                    c.execute("INSERT INTO metadata_fts (rowid, prompt, negative, model, sampler) VALUES (?, ?, ?, ?, ?)",
+                              (c.lastrowid, g["prompt"], g["negative"], g["model"], g["sampler"]))
+        self.metadata = []
+        self.conn.commit()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+def assign_root(c, root_id, root_path):
+    """
+    Points every directory under root_path at root_id, unless it already
+    belongs to a deeper (longer) root nested inside this one.
+    """
+    lo, hi = subtree_range(root_path)
+    c.execute('''UPDATE directories SET root_id = ?
+                 WHERE (path = ? OR (path >= ? AND path < ?))
+                 AND (root_id IS NULL OR root_id IN (SELECT id FROM scan_roots WHERE length(path) < ?))''',
+              (root_id, root_path, lo, hi, len(root_path)))
+
+def register_root(c, root_path):
+    """ Adds root_path to scan_roots (assigning its directories on first registration) and returns its id. """
+    c.execute("INSERT OR IGNORE INTO scan_roots (path) VALUES (?)", (root_path,))
+    is_new = c.rowcount == 1
+    root_id = c.execute("SELECT id FROM scan_roots WHERE path = ?", (root_path,)).fetchone()[0]
+    if is_new:
+        assign_root(c, root_id, root_path)
+    return root_id
+
+class DirectoryIndex:
+    """
+    Maps directory paths to rows of the directories table, creating missing
+    rows (and their parents) on demand with the deepest matching scan root.
+    """
+    def __init__(self, c):
+        self.c = c
+        self.ids = {}
+        roots = c.execute("SELECT id, path FROM scan_roots").fetchall()
+        self.roots = sorted(roots, key=lambda r: len(r[1]), reverse=True)
+
+    def root_for(self, dir_path):
+        for root_id, root_path in self.roots:
+            lo, hi = subtree_range(root_path)
+            if dir_path == root_path or lo <= dir_path < hi:
+                return root_id
+        return None
+
+    def get(self, dir_path):
+        dir_id = self.ids.get(dir_path)
+        if dir_id is not None:
+            return dir_id
+
+        row = self.c.execute("SELECT id FROM directories WHERE path = ?", (dir_path,)).fetchone()
+        if row:
+            dir_id = row[0]
+        else:
+            parent = os.path.dirname(dir_path)
+            parent_id = self.get(parent) if parent and parent != dir_path else None
+            self.c.execute("INSERT INTO directories (path, parent_id, root_id) VALUES (?, ?, ?)",
+                           (dir_path, parent_id, self.root_for(dir_path)))
+            dir_id = self.c.lastrowid
+        self.ids[dir_path] = dir_id
+        return dir_id
+
+class HashArray:
+    """
+    Hashes of one root held as a NumPy uint64 array, so matching against a
+    reference is a single vectorized XOR + popcount over every row.
+    """
+    def __init__(self, paths, mtimes, hashes):
+        self.paths = paths
+        self.mtimes = mtimes
+        self.hashes = np.asarray(hashes, dtype=np.int64).view(np.uint64)
+        self.chunk_index = [None] * 4
+
+    @classmethod
+    def from_db(cls, conn, folder=None, algorithm="ahash"):
+        column = HASH_COLUMNS[algorithm]
+        sql = f"SELECT path, mtime, {column} FROM files WHERE {column} IS NOT NULL"
+        args = ()
+        if folder:
+            sql += " AND path >= ? AND path < ?"
+            args = subtree_range(folder)
+        rows = conn.execute(sql, args).fetchall()
+        return cls([r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows])
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def distances(self, ref):
+        """ Hamming distance from `ref` (integer aHash) to every stored hash. """
+        return popcount64(self.hashes ^ np.uint64(ref & MASK64))
+
+    def query(self, ref, max_dist=MATCH_DISTANCE):
+        """ Returns {path: (mtime, hash, distance)} for every hash within max_dist of ref. """
+        dists = self.distances(ref)
+        hashes = self.hashes.view(np.int64)
+        return {self.paths[i]: (self.mtimes[i], int(hashes[i]), int(dists[i]))
+                for i in np.nonzero(dists <= max_dist)[0]}
+
+    def chunk_buckets(self, k):
+        """
+        (order, starts): rows sorted by the k-th 16-bit substring of their hash, and
+        the offset of every substring value in that order, so rows whose substring is
+        v are order[starts[v]:starts[v + 1]]. Built once per array.
+        """
+        if self.chunk_index[k] is None:
+            values = ((self.hashes >> np.uint64(48 - 16 * k)) & np.uint64(0xFFFF)).astype(np.uint16)
+            order = np.argsort(values, kind="stable")
+            starts = np.zeros(65537, dtype=np.int64)
+            np.cumsum(np.bincount(values, minlength=65536), out=starts[1:])
+            self.chunk_index[k] = (order, starts)
+        return self.chunk_index[k]
+
+    def match_pairs(self, refs, max_dist=MATCH_DISTANCE):
+        """
+        Matches every reference against every stored hash in one pass.
+        Returns (ref_pos, row, distance) arrays with one entry per matching pair.
+        Uses the same substring rule as HashIndex, with the probes of all references
+        looked up together in per-substring buckets (chunk_buckets); beyond
+        HashIndex.MAX_RADIUS it compares blocks of references against every row.
+        """
+        refs = np.asarray(refs, dtype=np.int64).view(np.uint64)
+        if not len(refs) or not len(self):
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+
+        radius = max_dist // 4
+        if radius > HashIndex.MAX_RADIUS:
+            block = max(1, (1 << 24) // len(self)) # ~16M distances per block
+            found = [[], [], []]
+            for start in range(0, len(refs), block):
+                part = refs[start:start + block]
+                dists = popcount64((part[:, None] ^ self.hashes[None, :]).ravel()).reshape(len(part), -1)
+                ref_pos, rows = np.nonzero(dists <= max_dist)
+                found[0].append(ref_pos + start)
+                found[1].append(rows)
+                found[2].append(dists[ref_pos, rows])
+            return tuple(np.concatenate(f).astype(np.int64) for f in found)
+
+        masks = np.array(HashIndex.probes(0, radius), dtype=np.uint16)
+        ranges = []
+        for k in range(4):
+            order, starts = self.chunk_buckets(k)
+            ref_chunks = ((refs >> np.uint64(48 - 16 * k)) & np.uint64(0xFFFF)).astype(np.uint16)
+            probe_values = (ref_chunks[:, None] ^ masks[None, :]).ravel()
+            lo = starts[probe_values]
+            ranges.append((order, lo, starts[probe_values.astype(np.int64) + 1] - lo))
+
+        # Crowded substrings (e.g. flat image regions) can produce huge candidate sets: split the batch
+        if len(refs) > 1 and sum(int(r[2].sum()) for r in ranges) > MAX_CANDIDATE_PAIRS:
+            mid = len(refs) // 2
+            first = self.match_pairs(refs[:mid].view(np.int64), max_dist)
+            second = self.match_pairs(refs[mid:].view(np.int64), max_dist)
+            return (np.concatenate([first[0], second[0] + mid]),
+                    np.concatenate([first[1], second[1]]), np.concatenate([first[2], second[2]]))
+
+        ref_ids, rows = [], []
+        for order, lo, counts in ranges:
+            total = int(counts.sum())
+            if not total: continue
+            # Expand each probe's [lo, hi) range into row positions
+            offsets = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+            rows.append(order[np.repeat(lo, counts) + offsets])
+            ref_ids.append(np.repeat(np.arange(len(refs)).repeat(len(masks)), counts))
+        if not rows:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+
+        ref_ids, rows = np.concatenate(ref_ids), np.concatenate(rows).astype(np.int64)
+        dists = popcount64(refs[ref_ids] ^ self.hashes[rows])
+        keep = dists <= max_dist
+        ref_ids, rows, dists = ref_ids[keep], rows[keep], dists[keep]
+        # A pair can be hit through more than one substring
+        _, first = np.unique(ref_ids * len(self) + rows, return_index=True)
+        return ref_ids[first], rows[first], dists[first].astype(np.int64)
+
+class MemoryIndex:
+    """
+    Every hash column of the index held in NumPy arrays, for long-running processes
+    (see finder_service.py) that would otherwise read SQLite for every query.
+    Rows are sorted by path, so a folder's rows are one contiguous slice; the
+    HashArrays of the MEMORY_INDEX_ARRAYS (folder, algorithm) pairs used last are
+    kept until reload().
+    is_stale() tells when another connection has committed since the last load;
+    call it and reload() from one thread at a time.
+    """
+    def __init__(self):
+        # Kept open: PRAGMA data_version only moves for other connections' commits
+        self.conn = sqlite3.connect(DB_NAME, timeout=30, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        c = self.conn.cursor()
+        c.execute("BEGIN") # One snapshot for all the column reads below
+        try:
+            version = c.execute("PRAGMA data_version").fetchone()[0]
+            paths, mtimes = [], []
+            for path, mtime in c.execute("SELECT path, mtime FROM files ORDER BY path"):
+                paths.append(path)
+                mtimes.append(mtime)
+            # One column at a time, straight into arrays: (hash or 0, is set) pairs
+            hashes = {}
+            for alg, col in HASH_COLUMNS.items():
+                rows = c.execute(f"SELECT COALESCE({col}, 0), {col} IS NOT NULL FROM files ORDER BY path")
+                flat = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64, count=2 * len(paths))
+                hashes[alg] = (flat[0::2].copy(), flat[1::2].astype(bool))
+        finally:
+            c.execute("COMMIT")
+        with self.lock:
+            self.paths, self.mtimes, self.hashes = paths, mtimes, hashes
+            self.arrays = collections.OrderedDict()
+            self.version = version
+            self.loaded_at = time.time()
+
+    def is_stale(self):
+        return self.conn.execute("PRAGMA data_version").fetchone()[0] != self.version
+
+    def __len__(self):
+        return len(self.paths)
+
+    def p_hash(self, path):
+        """ The indexed aHash of a path, or None. """
+        with self.lock:
+            row = bisect.bisect_left(self.paths, path)
+            if row < len(self.paths) and self.paths[row] == path and self.hashes["ahash"][1][row]:
+                return int(self.hashes["ahash"][0][row])
+        return None
+
+    def array(self, folder=None, algorithm="ahash"):
+        """ HashArray of the rows under folder (None = all) that have a hash for `algorithm`. """
+        with self.lock:
+            key = (folder, algorithm)
+            if key in self.arrays:
+                self.arrays.move_to_end(key)
+            else:
+                lo, hi = 0, len(self.paths)
+                if folder:
+                    start, end = subtree_range(folder)
+                    lo, hi = bisect.bisect_left(self.paths, start), bisect.bisect_left(self.paths, end)
+                values, present = self.hashes[algorithm]
+                rows = lo + np.nonzero(present[lo:hi])[0]
+                self.arrays[key] = HashArray([self.paths[i] for i in rows], [self.mtimes[i] for i in rows], values[rows])
+                while len(self.arrays) > MEMORY_INDEX_ARRAYS:
+                    self.arrays.popitem(last=False)
+            return self.arrays[key]
+
+class HashIndex:
+    """
+    Multi-index hashing over the indexed 16-bit substrings (files.h0..h3).
+    Two hashes within distance d share at least one substring within d // 4 bits,
+    so a query only reads rows hit by a few indexed lookups instead of every row.
+    The index lives in SQLite, so inserts and replaces keep it up to date.
+    """
+    MAX_RADIUS = 2 # Beyond this the probe sets grow too large; use a HashArray instead
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    @staticmethod
+    def probes(value, radius):
+        """ All 16-bit values within `radius` bits of `value` """
+        out = [value]
+        if radius >= 1:
+            out += [value ^ (1 << i) for i in range(16)]
+        if radius >= 2:
+            out += [value ^ (1 << i) ^ (1 << j) for i in range(16) for j in range(i + 1, 16)]
+        return out
+
+    def query(self, ref, max_dist=MATCH_DISTANCE, folder=None):
+        """ Returns {path: (mtime, p_hash, distance)} for every row within max_dist of ref. """
+        radius = max_dist // 4
+        if radius > self.MAX_RADIUS:
+            return HashArray.from_db(self.conn, folder).query(ref, max_dist)
+
+        chunks = hash_chunks(ref)
+        # Values are ints generated here, so inlining them is safe and avoids bind limits
+        sql = ("SELECT path, mtime, p_hash FROM files WHERE (" + " OR ".join(
+            f"h{k} IN ({','.join(map(str, self.probes(chunks[k], radius)))})"
+            for k in range(4)) + ")")
+        args = ()
+        if folder:
+            sql += " AND path >= ? AND path < ?"
+            args = subtree_range(folder)
+
+        results = {}
+        for path, mtime, p_hash in self.conn.execute(sql, args):
+            dist = hamming(ref, p_hash)
+            if dist <= max_dist:
+                results[path] = (mtime, p_hash, dist)
+        return results
+
+    def query_nearest(self, ref, k, max_dist=MATCH_DISTANCE, folder=None):
+        """
+        Like query(), but widens the probe radius one step at a time and stops as soon
+        as at least k rows are found. A radius r pass finds every row within 4r + 3 bits,
+        so no row left out can be closer than the k found.
+        Returns (results, reach) where reach is the distance searched exhaustively.
+        """
+        for radius in range(max_dist // 4 + 1):
+            reach = min(4 * radius + 3, max_dist)
+            results = self.query(ref, reach, folder)
+            if len(results) >= k or reach == max_dist:
+                return results, reach
+        return {}, max_dist
+
+class Descending:
+    """ Wraps a value so that it sorts in reverse, e.g. as a tie-break inside a heap entry. """
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+class Scanner:
+    """
+    Brings the index for a folder up to date and, given a reference hash,
+    yields a result dict for every match as soon as it is found.
+    Runs as a pipeline joined by bounded queues, so memory stays flat on big trees:
+      discovery thread -> lookup thread (cache check, hash pool) -> caller (SQLite, matching)
+    Progress goes to on_status(kind, data) with kind "status" or "progress".
+    `ref_hash` is an integer aHash or {algorithm: integer hash} with the hashes that
+    `algorithm` (one of QUERY_ALGORITHMS) compares; index rows missing those are rehashed.
+    `refs` ({key: integer aHash}) matches many references in the same pass; their
+    results carry the reference key under "ref".
+    With `top_k`, matches are kept in a bounded heap instead of being yielded as found,
+    and the best k are yielded at the end, by distance, then largest file first.
+    Timings and counters collect in `stats` (a ScanStats, see also STATS_INTERVAL); `profile`
+    is a file path for a cProfile dump of the thread running the scan.
+    `metadata` ({"text", "seed", "model"}, see search_metadata) keeps only matches whose
+    generation data fits; those among files hashed during the scan are reported at the end.
+    `pool` is a hash pool to use (and leave running) instead of starting one; with
+    register=False, folder_path is scanned without being added to scan_roots.
+    With index_only=True the folder is not walked at all (see run_index_only).
+    `index` is a MemoryIndex to find the index candidates in, instead of SQLite.
+    """
+    QUEUE_SIZE = 2000
+
+    def __init__(self, folder_path, ref_hash=None, max_dist=MATCH_DISTANCE,
+                 pool_kind=HASH_POOL, workers=HASH_WORKERS, on_status=None, refs=None,
+                 algorithm="ahash", top_k=None, profile=None, stats=None, metadata=None, pool=None, register=True,
+                 index_only=False, index=None):
+        self.folder_path = folder_path
+        self.ref_hash = {"ahash": ref_hash} if isinstance(ref_hash, int) else ref_hash
+        self.refs = dict(refs or {})
+        self.max_dist = max_dist
+        self.algorithm = algorithm
+        self.needed = query_algorithms(algorithm)
+        if self.ref_hash is not None and any(alg not in self.ref_hash for alg in self.needed):
+            raise ValueError(f"Reference has no {' / '.join(self.needed)} hash")
+        self.algorithms = tuple(dict.fromkeys(HASH_ALGORITHMS + self.needed))
+        self.top_k = top_k
+        self.metadata = metadata
+        self.best = [] # top_k heap of (-distance, bytes, Descending(path), result); best[0] is the worst kept
+        self.reach = max_dist # Distance up to which the index candidates are complete
+        self.pool_kind = pool_kind
+        self.workers = workers
+        self.pool = pool
+        self.register = register
+        self.index_only = index_only
+        self.index = index
+        self.on_status = on_status or (lambda kind, data: None)
+        self.profile = profile
+        self.stats = stats or ScanStats()
+        self.last_stats = time.time()
+        self.is_running = True
+        self.found_count = 0
+        self.moved_count = 0
+        self.discovery_done = False
+
+    def put(self, q, item):
+        """ Blocking put on a bounded queue that gives up once the scan is stopped. """
+        while self.is_running:
+            try:
+                q.put(item, timeout=0.2)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def find_moved(self, c, path, mtime, info):
+        """
+        Looks for the indexed row of a file that was moved or renamed to `path`:
+        same size and mtime, and gone from its old path. Rows seen vanishing during
+        this scan are checked first, then the index (for old directories not listed
+        yet, or outside this root). A row with the same inode and device is taken as is;
+        any other needs a stored partial hash equal to the new file's, since equal size
+        and mtime alone happen for unrelated files (e.g. from one batch export).
+        Returns (old_path, hashes) or None.
+        """
+        size, inode, dev = info
+        candidates = [r for r in self.vanished.get((size, mtime), []) if r[0] not in self.claimed]
+        if not candidates:
+            candidates = [(r[0], self.row_hashes(r[1], r[5:]), r[2], r[3], r[4]) for r in c.execute(
+                f"SELECT path, p_hash, inode, dev, partial_hash, {', '.join(EXTRA_HASH_COLUMNS)} FROM files "
+                "WHERE size = ? AND mtime = ? AND path != ?", (size, mtime, path))
+                if r[0] not in self.claimed and r[1] is not None and not os.path.lexists(r[0])]
+        if not candidates:
+            return None
+        same_inode = [r for r in candidates if inode and r[2] == inode and r[3] == dev]
+        if same_inode:
+            found = same_inode[0]
+        else:
+            fingerprinted = [r for r in candidates if r[4]]
+            if not fingerprinted:
+                return None
+            try:
+                fingerprint = partial_hash(path, size)
+            except OSError:
+                return None
+            matching = [r for r in fingerprinted if r[4] == fingerprint]
+            if not matching:
+                return None
+            found = matching[0]
+        self.claimed.add(found[0])
+        return found[0], found[1]
+
+    @staticmethod
+    def row_hashes(p_hash, extra):
+        """ {algorithm: hash} from an index row's p_hash and EXTRA_HASH_COLUMNS values, skipping NULLs. """
+        hashes = {alg: v for alg, v in zip([a for a in HASH_COLUMNS if a != "ahash"], extra) if v is not None}
+        if p_hash is not None:
+            hashes["ahash"] = p_hash
+        return hashes
+
+    def discover(self, c):
+        """
+        Yields ("file", path, mtime, cached, info, moved_from) for every image under
+        folder_path, plus a
+        ("listed", dir_path, dir_mtime, entry_count, present_paths, subdirs, gone_subdirs)
+        message for every directory that had to be listed.
+        Directories whose mtime matches the last completed listing are not listed
+        again: their files come from the index with their cached mtime (no stat),
+        and their subdirectories from the directories table.
+        `cached` is the indexed (mtime, hashes, size) or None, `info` the (size, inode, dev)
+        of listed files. A file found to be a moved index row gets that row's hash as
+        `cached` and its old path as `moved_from`. Index rows are read one directory
+        at a time, so memory scales with the largest directory rather than the whole index.
+        """
+        self.vanished = {} # (size, mtime) -> [(path, hashes, inode, dev, partial_hash)] of rows gone this scan
+        self.claimed = set() # old paths already taken over
+        extra = ", ".join(EXTRA_HASH_COLUMNS)
+        lo, hi = subtree_range(self.folder_path)
+        known = {} # path -> (id, mtime)
+        children = {} # parent_id -> [path]
+        for dir_id, path, parent_id, mtime in c.execute(
+                "SELECT id, path, parent_id, mtime FROM directories WHERE path = ? OR (path >= ? AND path < ?)",
+                (self.folder_path, lo, hi)).fetchall():
+            known[path] = (dir_id, mtime)
+            children.setdefault(parent_id, []).append(path)
+
+        stack = [self.folder_path]
+        while stack and self.is_running:
+            dir_path = stack.pop()
+            try:
+                with self.stats.phase("walk"):
+                    dir_mtime = os.stat(dir_path).st_mtime
+            except OSError:
+                continue
+
+            record = known.get(dir_path)
+            if INCREMENTAL_SCAN and record and record[1] == dir_mtime:
+                # Unchanged: reuse the cached listing
+                with self.stats.phase("index_read"):
+                    rows = c.execute(f"SELECT path, mtime, p_hash, size, {extra} FROM files WHERE dir_id = ?",
+                                     (record[0],)).fetchall()
+                for path, mtime, p_hash, size, *hashes in rows:
+                    yield ("file", path, mtime, (mtime, self.row_hashes(p_hash, hashes), size), None, None)
+                stack.extend(children.get(record[0], []))
+                continue
+
+            images, subdirs, entry_count = [], [], 0
+            try:
+                with self.stats.phase("walk"), os.scandir(dir_path) as it:
+                    for entry in it:
+                        entry_count += 1
+                        try:
+                            if entry.is_dir():
+                                if not entry.is_symlink(): subdirs.append(entry.path)
+                            elif os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                                images.append((entry.path, entry.stat().st_mtime, file_info(entry)))
+                        except OSError:
+                            pass
+            except OSError:
+                continue
+
+            cached_rows, gone = {}, set()
+            present = {p for p, m, i in images}
+            with self.stats.phase("index_read"):
+                if record:
+                    vanished = []
+                    for p, m, h, size, inode, dev, part, *hashes in c.execute(
+                            f"SELECT path, mtime, p_hash, size, inode, dev, partial_hash, {extra} FROM files "
+                            "WHERE dir_id = ?", (record[0],)):
+                        if p in present:
+                            cached_rows[p] = (m, self.row_hashes(h, hashes), size)
+                        else:
+                            vanished.append((p, m, h, size, inode, dev, part, *hashes))
+                    gone = set(children.get(record[0], [])) - set(subdirs)
+                    if DETECT_MOVES:
+                        for gone_path in gone:
+                            g_lo, g_hi = subtree_range(gone_path)
+                            vanished += c.execute(f"SELECT path, mtime, p_hash, size, inode, dev, partial_hash, {extra} "
+                                                  "FROM files WHERE path >= ? AND path < ?", (g_lo, g_hi)).fetchall()
+                        for p, m, h, size, inode, dev, part, *hashes in vanished:
+                            if size is not None and h is not None:
+                                self.vanished.setdefault((size, m), []).append(
+                                    (p, self.row_hashes(h, hashes), inode, dev, part))
+            yield ("listed", dir_path, dir_mtime, entry_count, present, subdirs, gone)
+            for path, mtime, info in images:
+                cached, moved_from = cached_rows.get(path), None
+                if DETECT_MOVES and not (cached and cached[0] == mtime):
+                    with self.stats.phase("index_read"):
+                        moved = self.find_moved(c, path, mtime, info)
+                    if moved:
+                        moved_from = moved[0]
+                        cached = (mtime, moved[1], None)
+                yield ("file", path, mtime, cached, info, moved_from)
+            stack.extend(subdirs)
+
+    def discovery_stage(self, out):
+        """ Stage 1: walks the tree on its own (read-only) connection. """
+        conn = connect_db()
+        try:
+            for item in self.discover(conn.cursor()):
+                if item[0] == "file":
+                    self.found_count += 1
+                if not self.put(out, item): break
+        except Exception as e:
+            print(f"Discovery error: {e}")
+        finally:
+            conn.close()
+            self.discovery_done = True
+            self.put(out, None)
+
+    def lookup_stage(self, inp, out, pool):
+        """
+        Stage 2: passes cache hits straight on and sends misses to the hash pool.
+        A semaphore bounds the jobs in flight so stop() takes effect within a few files.
+        """
+        window = threading.BoundedSemaphore(self.workers * 4)
+
+        def on_hashed(fut, path, info):
+            try:
+                path, mtime, hashes, timings, generation = fut.result()
+                self.stats.add_job(timings)
+                if hashes is None:
+                    self.stats.failed(path)
+                self.put(out, ("hashed", path, mtime, hashes, info, generation))
+            except Exception:
+                self.stats.failed(path)
+                self.put(out, ("failed",))
+            finally:
+                window.release()
+
+        while self.is_running:
+            try:
+                item = inp.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            if item is None: break
+            if item[0] != "file":
+                self.put(out, item)
+                continue
+
+            _, path, mtime, cached, info, moved_from = item
+            # Rows missing a hash this query compares are rehashed (with every algorithm) below
+            if cached and cached[0] == mtime and all(alg in cached[1] for alg in self.needed + ("ahash",)):
+                if info and cached[2] is None:
+                    # Moved file, or a row written before sizes were recorded: rewrite it without decoding
+                    self.put(out, ("reused", path, mtime, cached[1], info, moved_from))
+                else:
+                    self.put(out, ("hit", path, cached[1]))
+                continue
+
+            while self.is_running and not window.acquire(timeout=0.2):
+                pass
+            if not self.is_running: break
+            pool.submit(hash_job, (path, mtime, self.algorithms)).add_done_callback(
+                lambda fut, path=path, info=info: on_hashed(fut, path, info))
+
+        # Wait for the jobs still in flight before closing the stream
+        for _ in range(self.workers * 4):
+            while self.is_running and not window.acquire(timeout=0.2):
+                pass
+        self.put(out, None)
+
+    def apply_listing(self, c, dir_index, item):
+        """ Records a fresh directory listing and prunes rows for files and subdirectories that are gone. """
+        _, dir_path, dir_mtime, entry_count, present, subdirs, gone = item
+        dir_id = dir_index.get(dir_path)
+        c.executemany("DELETE FROM files WHERE path = ?",
+                      [r for r in c.execute("SELECT path FROM files WHERE dir_id = ?", (dir_id,)).fetchall()
+                       if r[0] not in present])
+        for gone_path in gone:
+            g_lo, g_hi = subtree_range(gone_path)
+            c.execute("DELETE FROM files WHERE path >= ? AND path < ?", (g_lo, g_hi))
+            c.execute("DELETE FROM directories WHERE path = ? OR (path >= ? AND path < ?)", (gone_path, g_lo, g_hi))
+        for sub in subdirs:
+            dir_index.get(sub)
+        # Saved only once the scan completes, so an interrupted scan never hides unhashed files
+        self.listed_dirs.append((dir_mtime, entry_count, dir_id))
+
+    def save_listed_dirs(self, c, scan_start):
+        # A directory modified within the last few seconds may change again within
+        # the same mtime tick, so it is left to be relisted next time.
+        c.executemany("UPDATE directories SET mtime = ?, entry_count = ? WHERE id = ?",
+                      [(m if m < scan_start - 2 else None, n, d) for m, n, d in self.listed_dirs])
+
+    def make_result(self, file_path, dist, size=None):
+        with self.stats.phase("match"):
+            return {
+                "path": file_path,
+                "name": os.path.basename(file_path),
+                "bytes": os.stat(file_path).st_size if size is None else size,
+                "distance": dist
+            }
+
+    def report_stats(self, final=False):
+        """ Sends a ScanStats snapshot as a "stats" event, and appends it to STATS_LOG if set. """
+        self.last_stats = time.time()
+        stats = dict(self.stats.snapshot(), final=final)
+        self.on_status("stats", stats)
+        if STATS_LOG:
+            try:
+                with open(STATS_LOG, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(dict(stats, folder=self.folder_path, time=round(time.time(), 3))) + "\n")
+            except Exception:
+                pass
+
+    def distance(self, hashes):
+        """ Distance from the reference under self.algorithm, or None if it isn't a match. """
+        if self.algorithm == "cascade":
+            if hamming(self.ref_hash["ahash"], hashes["ahash"]) > CASCADE_AHASH_DISTANCE:
+                return None
+            dist = hamming(self.ref_hash["phash"], hashes["phash"])
+        else:
+            dist = hamming(self.ref_hash[self.algorithm], hashes[self.algorithm])
+        return dist if dist <= self.max_dist else None
+
+    def limit(self):
+        """ Largest distance still worth reporting: max_dist, or the worst kept once the top_k heap is full. """
+        if self.top_k and len(self.best) >= self.top_k:
+            return -self.best[0][0]
+        return self.max_dist
+
+    def keep_best(self, result):
+        # Exactly the reverse of ranked()'s order, so the entry evicted is the one ranked last
+        entry = (-result["distance"], result["bytes"], Descending(result["path"]), result)
+        if len(self.best) < self.top_k:
+            heapq.heappush(self.best, entry)
+        else:
+            heapq.heappushpop(self.best, entry)
+
+    def ranked(self):
+        return [e[3] for e in sorted(self.best, key=lambda e: (-e[0], -e[1], e[3]["path"]))]
+
+    def index_candidates(self, conn):
+        """
+        {path: (mtime, p_hash, distance)} for indexed rows under the folder matching the reference.
+        aHash and the cascade's aHash stage use the HashIndex; other algorithms have no
+        substring index, so their column is matched with a HashArray.
+        For a top_k aHash query the index search stops once top_k rows are found
+        (setting self.reach to the distance it covered), unless a metadata filter may drop some.
+        """
+        if self.index:
+            return self.memory_candidates()
+        if self.algorithm == "ahash":
+            if self.top_k and not self.metadata:
+                candidates, self.reach = HashIndex(conn).query_nearest(
+                    self.ref_hash["ahash"], self.top_k, self.max_dist, self.folder_path)
+                return candidates
+            return HashIndex(conn).query(self.ref_hash["ahash"], self.max_dist, self.folder_path)
+        if self.algorithm != "cascade":
+            array = HashArray.from_db(conn, self.folder_path, self.algorithm)
+            dists = array.distances(self.ref_hash[self.algorithm])
+            rows = np.nonzero(dists <= self.max_dist)[0]
+            found = {array.paths[i]: int(dists[i]) for i in rows}
+            # Hits are checked against p_hash, so fetch it for the matching rows
+            candidates = {}
+            for start in range(0, len(rows), 500):
+                chunk = [array.paths[i] for i in rows[start:start + 500]]
+                for path, mtime, p_hash in conn.execute(
+                        f"SELECT path, mtime, p_hash FROM files WHERE path IN ({','.join('?' * len(chunk))})", chunk):
+                    candidates[path] = (mtime, p_hash, found[path])
+            return candidates
+
+        rough = HashIndex(conn).query(self.ref_hash["ahash"], CASCADE_AHASH_DISTANCE, self.folder_path)
+        paths = list(rough)
+        candidates = {}
+        for start in range(0, len(paths), 500):
+            chunk = paths[start:start + 500]
+            for path, dct_hash in conn.execute(
+                    f"SELECT path, dct_hash FROM files WHERE dct_hash IS NOT NULL AND path IN ({','.join('?' * len(chunk))})", chunk):
+                dist = hamming(self.ref_hash["phash"], dct_hash)
+                if dist <= self.max_dist:
+                    candidates[path] = (rough[path][0], rough[path][1], dist)
+        return candidates
+
+    def memory_candidates(self):
+        """ index_candidates() from self.index; it compares whole arrays anyway, so there is no early stop. """
+        if self.algorithm == "ahash":
+            return self.index.array(self.folder_path).query(self.ref_hash["ahash"], self.max_dist)
+        if self.algorithm != "cascade":
+            found = self.index.array(self.folder_path, self.algorithm).query(self.ref_hash[self.algorithm], self.max_dist)
+            # Hits are checked against p_hash
+            return {path: (mtime, self.index.p_hash(path), dist) for path, (mtime, value, dist) in found.items()}
+        rough = self.index.array(self.folder_path).query(self.ref_hash["ahash"], CASCADE_AHASH_DISTANCE)
+        fine = self.index.array(self.folder_path, "phash").query(self.ref_hash["phash"], self.max_dist)
+        return {path: (mtime, rough[path][1], dist) for path, (mtime, dct_hash, dist) in fine.items() if path in rough}
+
+    def batch_candidates(self, conn):
+        """
+        {path: [(ref_pos, p_hash, distance), ...]} for indexed rows under the folder
+        matching any of self.refs. Small batches use the HashIndex per reference;
+        larger ones load the root's hashes once and match them all in one pass.
+        """
+        values = list(self.refs.values())
+        candidates = {}
+        if len(values) <= BATCH_INDEX_QUERIES and not self.index:
+            index = HashIndex(conn)
+            for pos, value in enumerate(values):
+                for path, (mtime, p_hash, dist) in index.query(value, self.max_dist, self.folder_path).items():
+                    candidates.setdefault(path, []).append((pos, p_hash, dist))
+            return candidates
+
+        array = self.index.array(self.folder_path) if self.index else HashArray.from_db(conn, self.folder_path)
+        hashes = array.hashes.view(np.int64)
+        for pos, row, dist in zip(*array.match_pairs(values, self.max_dist)):
+            candidates.setdefault(array.paths[row], []).append((int(pos), int(hashes[row]), int(dist)))
+        return candidates
+
+    def run(self):
+        """ Generator: runs the scan, yielding result dicts for matches (none when ref_hash is None). """
+        if self.index_only:
+            yield from self.run_index_only()
+            return
+        profiler = None
+        if self.profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        writer = IndexWriter(stats=self.stats)
+        conn = writer.conn
+        c = conn.cursor()
+        
+        # Register Scan Root for Grouping
+        try:
+            if self.register:
+                register_root(c, self.folder_path)
+                conn.commit()
+        except Exception:
+            pass
+        dir_index = DirectoryIndex(c)
+        matching = self.ref_hash is not None
+        ref_keys = list(self.refs)
+        ref_values = np.asarray(list(self.refs.values()), dtype=np.int64).view(np.uint64)
+
+        # Matches among cached rows come from the index; the walk only confirms they are current.
+        candidates = {}
+        batch_candidates = {}
+        try:
+            if matching:
+                candidates = self.index_candidates(conn)
+            if ref_keys:
+                batch_candidates = self.batch_candidates(conn)
+        except Exception as e:
+            print(f"Index query error: {e}")
+
+        # Progress estimate: files indexed under this root last time, until discovery gives the real total
+        lo, hi = subtree_range(self.folder_path)
+        expected = c.execute("SELECT COUNT(*) FROM files WHERE path >= ? AND path < ?", (lo, hi)).fetchone()[0]
+
+        # --- PIPELINE ---
+        self.on_status("status", "Scanning directory...")
+        scan_start = time.time()
+        self.listed_dirs = [] # (mtime, entry_count, dir_id) to save on completion
+        found_q = queue.Queue(self.QUEUE_SIZE)
+        match_q = queue.Queue(self.QUEUE_SIZE)
+        pool = self.pool or make_hash_pool(self.pool_kind, self.workers)
+        threading.Thread(target=self.discovery_stage, args=(found_q,), daemon=True).start()
+        threading.Thread(target=self.lookup_stage, args=(found_q, match_q, pool), daemon=True).start()
+
+        # Stage 3 (caller's thread): the only SQLite writer, plus matching and reporting
+        done_count = 0
+        completed = False
+        deferred = [] # Matches awaiting the metadata filter
+        try:
+            while self.is_running:
+                try:
+                    item = match_q.get(timeout=0.2)
+                except queue.Empty:
+                    writer.maybe_flush()
+                    if time.time() - self.last_stats >= STATS_INTERVAL:
+                        self.report_stats()
+                    continue
+                if item is None:
+                    completed = True
+                    break
+
+                kind = item[0]
+                result = None
+                batch_results = []
+                try:
+                    if kind == "listed":
+                        with self.stats.phase("prune"):
+                            self.apply_listing(c, dir_index, item)
+                        if writer.rows:
+                            writer.maybe_flush()
+                        else:
+                            writer.flush() # Nothing else to batch with: don't hold the write lock for the prune
+                        continue
+
+                    done_count += 1
+                    self.stats.count("unreadable" if kind == "hashed" and not item[3] else kind)
+                    if kind == "hit":
+                        writer.maybe_flush() # A warm rescan is nearly all hits: don't keep the listings' deletes open
+                        _, file_path, hashes = item
+                        file_hash = hashes["ahash"]
+                        hit = candidates.get(file_path)
+                        if hit and hit[1] == file_hash and hit[2] <= self.limit():
+                            result = self.make_result(file_path, hit[2])
+                        for pos, p_hash, dist in batch_candidates.get(file_path, ()):
+                            if p_hash == file_hash:
+                                batch_results.append((pos, dist))
+
+                    elif (kind == "hashed" and item[3]) or kind == "reused":
+                        generation = None
+                        if kind == "hashed":
+                            _, file_path, mtime, hashes, info, generation = item
+                        else:
+                            _, file_path, mtime, hashes, info, moved_from = item
+                            if moved_from:
+                                c.execute("DELETE FROM files WHERE path = ?", (moved_from,))
+                                self.moved_count += 1
+                        file_hash = hashes["ahash"]
+                        # Write to DB
+                        writer.add(file_path, mtime, hashes, dir_index.get(os.path.dirname(file_path)), info, generation)
+
+                        # Compare
+                        if matching:
+                            dist = self.distance(hashes)
+                            if dist is not None and dist <= self.limit():
+                                result = self.make_result(file_path, dist)
+                        if ref_keys:
+                            dists = popcount64(ref_values ^ np.uint64(file_hash & MASK64))
+                            batch_results = [(pos, int(dists[pos])) for pos in np.nonzero(dists <= self.max_dist)[0]]
+                except Exception:
+                    pass
+
+                if result and self.metadata:
+                    # Generation data of files hashed just now is only searchable once written
+                    if kind != "hit":
+                        deferred.append(result)
+                        result = None
+                    elif not self.metadata_allows(conn, [result["path"]]):
+                        result = None
+                if result:
+                    if self.top_k:
+                        self.keep_best(result)
+                    else:
+                        yield result
+                for pos, dist in batch_results:
+                    try:
+                        yield dict(self.make_result(item[1], dist), ref=ref_keys[pos])
+                    except OSError:
+                        pass
+
+                # Update progress
+                if done_count % 20 == 0:
+                    if self.discovery_done:
+                        total = self.found_count
+                        self.on_status("status", f"Scanning: {done_count}/{total}")
+                    else:
+                        total = max(expected, self.found_count, 1)
+                        self.on_status("status", f"Scanning: {done_count}/~{total} (still searching...)")
+                    self.on_status("progress", min(done_count / max(total, 1) * 100, 100))
+                    if time.time() - self.last_stats >= STATS_INTERVAL:
+                        self.report_stats()
+
+            if completed and METADATA_INDEX:
+                self.fill_metadata(c, writer, pool)
+        finally:
+            # Also reached when the caller stops iterating early
+            self.is_running = self.is_running and completed
+            if pool is not self.pool:
+                pool.shutdown(wait=False)
+            writer.flush()
+
+            # Only a completed scan may mark directories as unchanged
+            if completed:
+                self.on_status("progress", 100)
+                moved = f" ({self.moved_count} moved, not rehashed)" if self.moved_count else ""
+                self.on_status("status", f"Scanning: {done_count}/{self.found_count}{moved}")
+                self.save_listed_dirs(c, scan_start)
+            writer.close()
+            self.report_stats(final=True)
+            if profiler:
+                profiler.disable()
+                profiler.dump_stats(self.profile)
+
+        if deferred and completed:
+            conn = connect_db()
+            try:
+                allowed = self.metadata_allows(conn, [r["path"] for r in deferred])
+            finally:
+                conn.close()
+            for result in deferred:
+                if result["path"] in allowed:
+                    if self.top_k:
+                        self.keep_best(result)
+                    else:
+                        yield result
+
+        if self.top_k and matching:
+            # Candidates found stale during the scan can leave the heap short, or filled from
+            # beyond the distance the early-stopped index search covered. The index is
+            # current now, so search it again for the rows that may have been missed.
+            if completed and self.reach < self.max_dist and (len(self.best) < self.top_k or self.limit() > self.reach):
+                self.refill_best()
+            yield from self.ranked()
+
+    def run_index_only(self):
+        """
+        run() without the walk: matches come straight from the index, and only those rows
+        are checked against the disk (see verify), so the answer takes a few lookups and a
+        stat per match however large the folder is. Images added since the last scan, and
+        rows missing the hashes the algorithm compares, are not found; a later scan
+        (or the watcher in finder_watch) reconciles the rest of the index.
+        """
+        if not os.path.isdir(self.folder_path):
+            # E.g. an unplugged drive: its rows must not all be pruned as vanished
+            self.on_status("status", f"Folder not found: {self.folder_path}")
+            return
+        writer = IndexWriter(stats=self.stats)
+        conn = writer.conn
+        ref_keys = list(self.refs)
+        ref_values = np.asarray(list(self.refs.values()), dtype=np.int64).view(np.uint64)
+        self.on_status("status", "Searching the index...")
+        try:
+            with self.stats.phase("index_read"):
+                candidates = self.index_candidates(conn) if self.ref_hash is not None else {}
+                batch_candidates = self.batch_candidates(conn) if ref_keys else {}
+            checked = set()
+            while self.is_running:
+                paths = [p for p in dict.fromkeys(list(candidates) + list(batch_candidates)) if p not in checked]
+                checked.update(paths)
+                results, batch_results = [], []
+                for path, (size, hashes) in self.verify(conn, writer, paths).items():
+                    if path in candidates:
+                        dist = candidates[path][2] if hashes is None else self.distance(hashes)
+                        if dist is not None and dist <= self.limit():
+                            results.append(self.make_result(path, dist, size))
+                    if hashes is None:
+                        batch_results += [(path, size, pos, dist) for pos, p_hash, dist in batch_candidates.get(path, ())]
+                    elif ref_keys:
+                        dists = popcount64(ref_values ^ np.uint64(hashes["ahash"] & MASK64))
+                        batch_results += [(path, size, pos, int(dists[pos]))
+                                          for pos in np.nonzero(dists <= self.max_dist)[0]]
+
+                if self.metadata and results:
+                    allowed = self.metadata_allows(conn, [r["path"] for r in results])
+                    results = [r for r in results if r["path"] in allowed]
+                for result in results:
+                    if self.top_k:
+                        self.keep_best(result)
+                    else:
+                        yield result
+                for path, size, pos, dist in batch_results:
+                    yield dict(self.make_result(path, dist, size), ref=ref_keys[pos])
+
+                # Rows dropped as stale can leave an early-stopped top_k search short: search the rest
+                if self.top_k and self.reach < self.max_dist and (len(self.best) < self.top_k or self.limit() > self.reach):
+                    with self.stats.phase("index_read"):
+                        candidates = HashIndex(conn).query(self.ref_hash["ahash"], self.max_dist, self.folder_path)
+                    batch_candidates = {}
+                    self.reach = self.max_dist
+                    continue
+                break
+            self.on_status("status", f"Searched the index: {len(checked)} candidates checked")
+        finally:
+            writer.close()
+            self.report_stats(final=True)
+        if self.top_k:
+            yield from self.ranked()
+
+    def verify(self, conn, writer, paths):
+        """
+        Checks index rows against the disk with a stat each. Returns {path: (bytes, hashes)}
+        for the files still there: hashes is None if the file is unchanged since it was
+        indexed, else its new hashes, which are written to the index. Rows of files that
+        are gone are deleted.
+        """
+        c = conn.cursor()
+        indexed = {}
+        with self.stats.phase("index_read"):
+            for start in range(0, len(paths), 500):
+                chunk = paths[start:start + 500]
+                indexed.update(c.execute(f"SELECT path, mtime FROM files WHERE path IN ({','.join('?' * len(chunk))})",
+                                         chunk))
+        found, stale = {}, []
+        with self.stats.phase("verify"):
+            for path in paths:
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    c.execute("DELETE FROM files WHERE path = ?", (path,))
+                    self.stats.count("pruned")
+                    continue
+                if st.st_mtime == indexed.get(path):
+                    self.stats.count("hit")
+                    found[path] = (st.st_size, None)
+                else:
+                    stale.append((path, st))
+
+        if stale:
+            dir_index = DirectoryIndex(c)
+            pool = self.pool or make_hash_pool(self.pool_kind, min(self.workers, len(stale)))
+            try:
+                jobs = [(path, st.st_mtime, self.algorithms) for path, st in stale]
+                for (path, st), (_, mtime, hashes, timings, generation) in zip(stale, pool.map(hash_job, jobs)):
+                    self.stats.add_job(timings)
+                    if hashes is None:
+                        self.stats.failed(path)
+                        continue
+                    self.stats.count("hashed")
+                    writer.add(path, mtime, hashes, dir_index.get(os.path.dirname(path)),
+                               (st.st_size, st.st_ino, st.st_dev), generation)
+                    found[path] = (st.st_size, hashes)
+            finally:
+                if pool is not self.pool:
+                    pool.shutdown()
+        writer.flush()
+        return found
+
+    def metadata_allows(self, conn, paths):
+        """ The subset of `paths` whose generation data fits self.metadata. """
+        allowed = set()
+        for i in range(0, len(paths), 500):
+            allowed.update(r["path"] for r in search_metadata(conn, paths=paths[i:i + 500], **self.metadata))
+        return allowed
+
+    def fill_metadata(self, c, writer, pool):
+        """ Reads the generation info of rows under the folder indexed before metadata was (headers only). """
+        writer.flush()
+        lo, hi = subtree_range(self.folder_path)
+        todo = [r[0] for r in c.execute("SELECT path FROM files WHERE path >= ? AND path < ? AND meta_read IS NULL",
+                                        (lo, hi)).fetchall()]
+        for start in range(0, len(todo), IndexWriter.BATCH_SIZE):
+            if not self.is_running:
+                break
+            for path, generation in pool.map(metadata_job, todo[start:start + IndexWriter.BATCH_SIZE], chunksize=64):
+                if generation is not None:
+                    writer.add_metadata(path, generation)
+            self.on_status("status", f"Reading AI metadata: {min(start + IndexWriter.BATCH_SIZE, len(todo))}/{len(todo)}")
+
+    def refill_best(self):
+        conn = connect_db()
+        try:
+            rows, _ = HashIndex(conn).query_nearest(self.ref_hash["ahash"], self.top_k, self.max_dist, self.folder_path)
+        finally:
+            conn.close()
+        kept = {e[3]["path"] for e in self.best}
+        for path, (mtime, p_hash, dist) in rows.items():
+            if path not in kept and dist <= self.limit():
+                try:
+                    self.keep_best(self.make_result(path, dist))
+                except OSError:
+                    pass
+
+    def stop(self):
+        self.is_running = False
+
+def resolve_ref(ref):
+    """
+    Turns a query reference into an integer aHash. Accepts an integer hash,
+    a 16-digit hex hash or an image path. Raises ValueError if unreadable.
+    """
+    if isinstance(ref, int):
+        return ref
+    if os.path.isfile(ref):
+        hex_hash = calculate_hash(ref)
+        if not hex_hash:
+            raise ValueError(f"Could not read reference image: {ref}")
+        return hash_to_int(hex_hash)
+    try:
+        if len(ref) == 16:
+            return hash_to_int(ref)
+    except ValueError:
+        pass
+    raise ValueError(f"Not an image file or 16-digit hex hash: {ref}")
+
+def fill_content_hashes(conn, pool, rows, col, func, on_status, label):
+    """
+    Computes func(row) on the pool for rows ([path, mtime, size, partial_hash, digest])
+    whose column `col` (3 or 4) is empty, and caches the values of rows still current
+    (mtime not None).
+    """
+    todo = [r for r in rows if r[col] is None]
+
+    def job(r):
+        try:
+            return func(r)
+        except OSError:
+            return None
+
+    for n, (r, value) in enumerate(zip(todo, pool.map(job, todo)), 1):
+        r[col] = value
+        if n % 200 == 0:
+            on_status("status", f"{label}: {n}/{len(todo)}")
+            on_status("progress", n / len(todo) * 100)
+    column = "partial_hash" if col == 3 else "digest"
+    conn.executemany(f"UPDATE files SET {column} = ? WHERE path = ? AND mtime = ?",
+                     [(r[col], r[0], r[1]) for r in todo if r[col] and r[1] is not None])
+    conn.commit()
+
+def find_exact_duplicates(folder_path, on_status=None, rescan=True, workers=HASH_WORKERS, **kwargs):
+    """
+    Groups byte-identical images under folder_path, reading as little as possible:
+    files are grouped by size, equal sizes by partial_hash(), and only files whose
+    partial hashes still collide are read in full. Partial hashes and digests are
+    cached in the files table. With rescan, the index is brought up to date first.
+    Returns [{"size", "digest", "wasted", "paths"}], most wasted bytes first.
+    """
+    on_status = on_status or (lambda kind, data: None)
+    if rescan:
+        index_root(folder_path, on_status=on_status, workers=workers, **kwargs)
+
+    conn = connect_db()
+    try:
+        lo, hi = subtree_range(folder_path)
+        rows = conn.execute("SELECT path, mtime, size, partial_hash, digest FROM files "
+                            "WHERE path >= ? AND path < ?", (lo, hi)).fetchall()
+
+        # Stage 1: size. Rows indexed before sizes were recorded are stat-ed once.
+        by_size, sizes = {}, []
+        for path, mtime, size, partial, digest in rows:
+            if size is None:
+                try:
+                    size = os.stat(path).st_size
+                    sizes.append((size, path))
+                except OSError:
+                    continue
+            if size > 0:
+                by_size.setdefault(size, []).append([path, mtime, size, partial, digest])
+        if sizes:
+            conn.executemany("UPDATE files SET size = ? WHERE path = ?", sizes)
+            conn.commit()
+        candidates = [r for group in by_size.values() if len(group) > 1 for r in group]
+
+        # A file changed since it was indexed can't use (or store) cached hashes
+        current = []
+        for r in candidates:
+            try:
+                st = os.stat(r[0])
+            except OSError:
+                continue
+            if st.st_mtime != r[1] or st.st_size != r[2]:
+                r[1], r[2], r[3], r[4] = None, st.st_size, None, None
+            current.append(r)
+
+        # Content hashing is I/O bound, so threads are enough
+        pool = ThreadPoolExecutor(max_workers=workers)
+        try:
+            # Stage 2: head + tail hash within each size group
+            fill_content_hashes(conn, pool, current, 3, lambda r: partial_hash(r[0], r[2]),
+                                on_status, "Comparing file ends")
+            by_partial = {}
+            for r in current:
+                if r[3]:
+                    by_partial.setdefault((r[2], r[3]), []).append(r)
+
+            # Stage 3: full digest only where partial hashes still collide
+            colliding = [r for group in by_partial.values() if len(group) > 1 for r in group]
+            fill_content_hashes(conn, pool, colliding, 4,
+                                lambda r: r[3] if r[2] <= 2 * PARTIAL_HASH_BYTES else content_digest(r[0]),
+                                on_status, "Reading files")
+        finally:
+            pool.shutdown()
+    finally:
+        conn.close()
+
+    by_digest = {}
+    for r in colliding:
+        if r[4]:
+            by_digest.setdefault((r[2], r[4]), []).append(r[0])
+    groups = [{"size": size, "digest": digest, "wasted": size * (len(paths) - 1), "paths": sorted(paths)}
+              for (size, digest), paths in by_digest.items() if len(paths) > 1]
+    groups.sort(key=lambda g: (-g["wasted"], g["paths"][0]))
+    on_status("progress", 100)
+    on_status("status", f"Found {len(groups)} groups of exact duplicates")
+    return groups
+
+def flatten_roots(parent):
+    """ Pointer-jumps a union-find parent array in place until every entry points at its root. """
+    while True:
+        grand = parent[parent]
+        if np.array_equal(grand, parent):
+            return parent
+        parent[:] = grand
+
+def union_pairs(parent, a, b):
+    """
+    Vectorized union-find: merges the sets of every (a[i], b[i]) pair. Each round
+    links the larger root of every unmerged pair to the smaller one, then flattens.
+    """
+    while len(a):
+        flatten_roots(parent)
+        ra, rb = parent[a], parent[b]
+        apart = ra != rb
+        if not apart.any():
+            break
+        a, b, ra, rb = a[apart], b[apart], ra[apart], rb[apart]
+        np.minimum.at(parent, np.maximum(ra, rb), np.minimum(ra, rb))
+    return flatten_roots(parent)
+
+def spanning_links(a, b):
+    """ Reduces a list of pairs to one (node, root) link per node that isn't its own root. """
+    nodes, inverse = np.unique(np.concatenate([a, b]), return_inverse=True)
+    parent = union_pairs(np.arange(len(nodes)), inverse[:len(a)], inverse[len(a):])
+    linked = parent != np.arange(len(nodes))
+    return nodes[linked], nodes[parent[linked]]
+
+cluster_array = None # Per-worker HashArray of the distinct hashes being clustered
+
+def init_cluster_worker(hashes):
+    global cluster_array
+    cluster_array = HashArray(None, None, hashes)
+
+def cluster_job(job):
+    """
+    Pool worker: (start, stop, max_dist) -> links joining every distinct hash in
+    [start, stop) to the hashes within max_dist of it, reduced to a spanning forest.
+    """
+    start, stop, max_dist = job
+    refs = cluster_array.hashes[start:stop].view(np.int64)
+    ref_pos, rows, _ = cluster_array.match_pairs(refs, max_dist)
+    ref_pos = ref_pos + start
+    later = rows > ref_pos # Each pair once, and not the hash itself
+    if not later.any():
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty
+    return spanning_links(ref_pos[later], rows[later])
+
+def find_near_duplicates(folder_path=None, max_dist=MATCH_DISTANCE, on_status=None,
+                         pool_kind=HASH_POOL, workers=HASH_WORKERS, should_stop=None, algorithm="ahash"):
+    """
+    Clusters every indexed image (under folder_path, or the whole index) with the
+    images within max_dist of it, transitively. This is a similarity join rather than
+    all pairs: identical hashes are collapsed first, then each distinct hash only meets
+    the hashes sharing a 16-bit substring within max_dist // 4 bits (the HashIndex rule),
+    found through per-substring buckets. Jobs run on a pool and their pairs
+    are merged with a vectorized union-find, so memory holds links, not pairs.
+    Yields clusters, largest first: {"id", "count", "members": [{"path", "distance"}]}
+    where distance is measured from the first member.
+    Above max_dist 11 the join falls back to comparing all hashes (small indexes only).
+    `algorithm` picks the stored hash to cluster on; rows without it are left out.
+    """
+    if algorithm not in HASH_COLUMNS:
+        raise ValueError(f"Can only cluster on one of: {', '.join(HASH_COLUMNS)}")
+    on_status = on_status or (lambda kind, data: None)
+    should_stop = should_stop or (lambda: False)
+    conn = connect_db()
+    try:
+        on_status("status", "Loading hashes...")
+        array = HashArray.from_db(conn, folder_path, algorithm)
+    finally:
+        conn.close()
+    if not len(array):
+        return
+
+    distinct, inverse = np.unique(array.hashes, return_inverse=True)
+    inverse = inverse.ravel()
+    parent = np.arange(len(distinct))
+    jobs = [(start, min(start + CLUSTER_JOB_HASHES, len(distinct)), max_dist)
+            for start in range(0, len(distinct), CLUSTER_JOB_HASHES)]
+    executor = ProcessPoolExecutor if pool_kind == "process" else ThreadPoolExecutor
+    pool = executor(max_workers=workers, initializer=init_cluster_worker, initargs=(distinct.view(np.int64),))
+    try:
+        for n, (a, b) in enumerate(pool.map(cluster_job, jobs), 1):
+            union_pairs(parent, a, b)
+            on_status("status", f"Clustering: {jobs[n - 1][1]}/{len(distinct)} distinct hashes")
+            on_status("progress", n / len(jobs) * 100)
+            if should_stop():
+                return
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    # Rows grouped by cluster root; only clusters of more than one image, largest first
+    labels = parent[inverse]
+    order = np.argsort(labels, kind="stable")
+    starts = np.flatnonzero(np.r_[True, np.diff(labels[order]) != 0])
+    sizes = np.diff(np.r_[starts, len(order)])
+    multi = np.flatnonzero(sizes > 1)
+    multi = multi[np.argsort(-sizes[multi], kind="stable")]
+    groups = [order[starts[i]:starts[i] + sizes[i]] for i in multi]
+    on_status("status", f"Found {len(groups)} clusters of near-duplicates")
+    on_status("progress", 100)
+    for cluster_id, rows in enumerate(groups, 1):
+        dists = popcount64(array.hashes[rows] ^ array.hashes[rows[0]])
+        members = sorted(({"path": array.paths[r], "distance": int(d)} for r, d in zip(rows, dists)),
+                         key=lambda m: (m["distance"], m["path"]))
+        yield {"id": cluster_id, "count": len(members), "members": members}
+
+def resolve_ref_hashes(ref, algorithm="ahash"):
+    """
+    The reference hashes a query with `algorithm` needs, as {algorithm: integer hash}.
+    An image is hashed with all of them; an integer or hex hash is taken as that
+    algorithm's hash (so not for "cascade"). Raises ValueError if unusable.
+    """
+    needed = query_algorithms(algorithm)
+    if isinstance(ref, str) and os.path.isfile(ref):
+        hashes = calculate_hashes(ref, needed)
+        if not hashes:
+            raise ValueError(f"Could not read reference image: {ref}")
+        return {alg: hash_to_int(h) for alg, h in hashes.items()}
+    if len(needed) > 1:
+        raise ValueError(f"{algorithm} queries need a reference image")
+    if isinstance(ref, int):
+        return {algorithm: ref}
+    try:
+        if 0 < len(ref) <= 16:
+            return {algorithm: hash_to_int(ref)}
+    except ValueError:
+        pass
+    raise ValueError(f"Not an image file or hex hash of up to 16 digits: {ref}")
+
+def fts_phrases(text):
+    """ Plain words as an FTS5 query that ignores operator syntax: every word must appear. """
+    return " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+def search_metadata(conn, text=None, seed=None, model=None, folder=None, paths=None, limit=None):
+    """
+    Indexed images by generation data: `text` is an FTS5 query over prompt, negative
+    prompt, model and sampler (falling back to plain words if it isn't valid FTS5 syntax),
+    `seed` an exact seed, `model` words of the model name. `folder` and `paths` restrict the rows.
+    Returns [{path, seed, steps, model, sampler, prompt}] sorted by path; with `limit`, the
+    first `limit` rows found, so a common word doesn't sort the whole library.
+    """
+    match = []
+    if text:
+        match.append(f"({text})")
+    if model:
+        match.append(f"model : ({fts_phrases(model)})")
+    where, args = [], []
+    if match:
+        where.append("metadata_fts MATCH ?")
+        args.append(" AND ".join(match))
+    if seed is not None:
+        where.append("m.seed = ?")
+        args.append(str(seed))
+    if folder:
+        where.append("m.path >= ? AND m.path < ?")
+        args += subtree_range(folder)
+    if paths is not None:
+        where.append(f"m.path IN ({', '.join('?' * len(paths))})")
+        args += paths
+    sql = ("SELECT m.path, m.seed, m.steps, m.model, m.sampler, metadata_fts.prompt FROM metadata m "
+           "JOIN metadata_fts ON metadata_fts.rowid = m.id"
+           + (" WHERE " + " AND ".join(where) if where else "")
+           + (f" LIMIT {int(limit)}" if limit else ""))
+    try:
+        rows = conn.execute(sql, args).fetchall()
+    except sqlite3.OperationalError:
+        if not text:
+            raise
+        args[0] = " AND ".join([fts_phrases(text)] + match[1:])
+        rows = conn.execute(sql, args).fetchall()
+    rows.sort()
+    return [dict(zip(("path", "seed", "steps", "model", "sampler", "prompt"), r)) for r in rows]
+
+def parse_metadata_query(query):
+    """ "seed:123 model:xl castle at night" -> {"seed": "123", "model": "xl", "text": "castle at night"}. """
+    out, words = {}, []
+    for word in query.split():
+        key, _, value = word.partition(":")
+        if key.lower() in ("seed", "model") and value:
+            out[key.lower()] = value
+        else:
+            words.append(word)
+    if words:
+        out["text"] = " ".join(words)
+    return out
+
+def lookup_generation_info(conn, path):
+    """ The indexed generation fields of one file, or None. """
+    row = conn.execute("SELECT m.source, m.seed, m.steps, m.model, m.sampler, f.prompt, f.negative FROM metadata m "
+                       "JOIN metadata_fts f ON f.rowid = m.id WHERE m.path = ?", (path,)).fetchone()
+    return dict(zip(("source", "seed", "steps", "model", "sampler", "prompt", "negative"), row)) if row else None
+
+def folder_counts(conn):
+    """ {folder: indexed file count} for the Cache Manager: per scan root, plus parent folders of rows outside any root. """
+    c = conn.cursor()
+
+    # 1. Files under registered Scan Roots (directories carry their root id)
+    c.execute('''SELECT r.path, COUNT(*) FROM directories d
+                 JOIN scan_roots r ON r.id = d.root_id
+                 JOIN files f ON f.dir_id = d.id
+                 GROUP BY r.id''')
+    groups = dict(c.fetchall()) # folder_path -> count
+
+    # 2. Legacy data / Uncategorized: Group by immediate parent folder
+    c.execute('''SELECT d.path, COUNT(*) FROM directories d
+                 JOIN files f ON f.dir_id = d.id
+                 WHERE d.root_id IS NULL
+                 GROUP BY d.id''')
+    for folder, count in c.fetchall():
+        groups[folder] = groups.get(folder, 0) + count
+    return groups
+
+def index_root(folder_path, on_status=None, **kwargs):
+    """ Brings the index for folder_path up to date. Returns the number of images found. """
+    scanner = Scanner(folder_path, on_status=on_status, **kwargs)
+    for _ in scanner.run():
+        pass
+    return scanner.found_count
+
+def query(folder_path, ref, max_dist=MATCH_DISTANCE, on_status=None, algorithm="ahash", **kwargs):
+    """
+    Yields a result dict (path, name, bytes, distance) for every image under folder_path
+    within max_dist of `ref` (see resolve_ref_hashes) under `algorithm`, updating the
+    index on the way. With top_k=N, yields only the N best, ranked, once the scan is done.
+    """
+    scanner = Scanner(folder_path, resolve_ref_hashes(ref, algorithm), max_dist, on_status=on_status,
+                      algorithm=algorithm, **kwargs)
+    yield from scanner.run()
+
+def resolve_refs(refs, pool_kind=HASH_POOL, workers=HASH_WORKERS):
+    """
+    resolve_ref for many references, hashing the reference images on the hash pool.
+    Returns {ref: integer aHash or ValueError} in input order.
+    """
+    refs = list(dict.fromkeys(refs))
+    images = [r for r in refs if isinstance(r, str) and os.path.isfile(r)]
+    hashed = {}
+    if images:
+        pool = make_hash_pool(pool_kind, workers)
+        try:
+            hashed = dict(zip(images, pool.map(calculate_hash, images)))
+        finally:
+            pool.shutdown()
+
+    resolved = {}
+    for ref in refs:
+        try:
+            if ref in hashed:
+                if not hashed[ref]:
+                    raise ValueError(f"Could not read reference image: {ref}")
+                resolved[ref] = hash_to_int(hashed[ref])
+            else:
+                resolved[ref] = resolve_ref(ref)
+        except ValueError as e:
+            resolved[ref] = e
+    return resolved
+
+def query_batch(folder_path, refs, max_dist=MATCH_DISTANCE, on_status=None, top_k=None, **kwargs):
+    """
+    Matches many references (see resolve_ref) with a single scan of folder_path.
+    Returns {ref: [result dict, ...]} in input order, each list sorted by distance,
+    then largest file first, and cut to top_k if given.
+    References that cannot be read map to a ValueError instead of a list.
+    """
+    grouped = resolve_refs(refs, kwargs.get("pool_kind", HASH_POOL), kwargs.get("workers", HASH_WORKERS))
+    resolved = {ref: v for ref, v in grouped.items() if not isinstance(v, ValueError)}
+    for ref in resolved:
+        grouped[ref] = []
+    if resolved:
+        scanner = Scanner(folder_path, max_dist=max_dist, on_status=on_status, refs=resolved, **kwargs)
+        for res in scanner.run():
+            grouped[res.pop("ref")].append(res)
+    for results in grouped.values():
+        if isinstance(results, list):
+            results.sort(key=lambda r: (r["distance"], -r["bytes"], r["path"]))
+            del results[top_k or len(results):]
+    return grouped
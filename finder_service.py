@@ -0,0 +1,252 @@
+r"""
+Resident query service for SourceSeeker: loads the hash index into memory once
+(finder_core.MemoryIndex) and answers lookups over HTTP on localhost, so the
+app and scripts get millisecond answers without each reading the index again.
+
+    python finder_cli.py serve
+    python finder_cli.py --service http://127.0.0.1:8765 query "D:\My Art Library" screenshot.png
+    python finder_cli.py --service http://127.0.0.1:8765 batch "D:\My Art Library" "D:\Screenshots"
+    python finder_cli.py --service http://127.0.0.1:8765 index "D:\My Art Library"
+
+Queries are answered like `query --index-only`: candidates come from memory and
+only they are checked on disk. The memory copy is reloaded in the background
+whenever another process (a scan, the watcher) commits to the database.
+Requests are JSON, POSTed to /query, /batch and /index; GET /status reports
+the loaded index. Every request runs on a thread of its own and hashing shares
+one pool. Only listens on localhost: anyone who can reach the port can read
+the index and trigger scans. Browsers are kept out: requests with an Origin
+header or a Host other than the bound address are refused, and POSTs must be
+application/json, which a web page can't send cross-site without an Origin.
+"""
+import os
+import json
+import time
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import finder_core as core
+
+# --- CONFIGURATION ---
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+SERVICE_URL = f"http://{SERVICE_HOST}:{SERVICE_PORT}"
+
+# How often the service checks the database for commits made by other processes. Reloading
+# a big index takes seconds, so after such commits (e.g. the watcher's) it is reloaded at most
+# every RELOAD_MIN_SECONDS; matches are checked on disk anyway. Its own /index reloads at once.
+RELOAD_CHECK_SECONDS = 2.0
+RELOAD_MIN_SECONDS = 30.0
+
+# Client side: index requests scan whole folders, so allow them plenty of time
+SERVICE_TIMEOUT = 3600
+
+class QueryService:
+    """ Serves the endpoints below from one MemoryIndex until shutdown(). """
+    def __init__(self, host=SERVICE_HOST, port=SERVICE_PORT, pool_kind=core.HASH_POOL, workers=core.HASH_WORKERS,
+                 on_status=None):
+        self.on_status = on_status or (lambda kind, data: None)
+        start = time.time()
+        self.index = core.MemoryIndex()
+        self.on_status("status", f"Loaded {len(self.index)} index rows in {time.time() - start:.1f}s")
+        self.pool_kind = pool_kind
+        self.workers = workers
+        self.pool = core.make_hash_pool(pool_kind, workers)
+        self.update_lock = threading.Lock() # One index update at a time; SQLite has a single writer anyway
+        self.changed = threading.Event()
+        self.is_running = True
+        self.server = ThreadingHTTPServer((host, port), ServiceHandler)
+        self.server.daemon_threads = True
+        self.server.service = self
+
+    def serve_forever(self):
+        threading.Thread(target=self.reload_loop, daemon=True).start()
+        self.on_status("status", f"Serving on http://{self.server.server_address[0]}:{self.server.server_address[1]}")
+        try:
+            self.server.serve_forever()
+        finally:
+            self.is_running = False
+            self.changed.set()
+            self.server.server_close()
+            self.pool.shutdown(wait=False)
+
+    def shutdown(self):
+        self.server.shutdown()
+
+    def reload_loop(self):
+        """ Swaps in a fresh MemoryIndex load after commits; queries keep using the old one meanwhile. """
+        while self.is_running:
+            forced = self.changed.wait(RELOAD_CHECK_SECONDS)
+            self.changed.clear()
+            try:
+                due = forced or time.time() - self.index.loaded_at >= RELOAD_MIN_SECONDS
+                if self.is_running and due and self.index.is_stale():
+                    start = time.time()
+                    self.index.reload()
+                    self.on_status("status", f"Reloaded {len(self.index)} index rows in {time.time() - start:.1f}s")
+            except Exception as e:
+                print(f"Index reload error: {e}")
+
+    @staticmethod
+    def limits(req):
+        """ (max_distance, top_k) of a request as ints; ValueError when out of range. """
+        max_dist = int(req.get("max_distance", core.MATCH_DISTANCE))
+        if not 0 <= max_dist <= 64:
+            raise ValueError(f"max_distance must be between 0 and 64, not {max_dist}")
+        top_k = req.get("top_k")
+        if top_k is not None:
+            top_k = int(top_k)
+            if top_k < 1:
+                raise ValueError(f"top_k must be at least 1, not {top_k}")
+        return max_dist, top_k
+
+    @staticmethod
+    def algorithm(req):
+        """ The request's algorithm, one of core.QUERY_ALGORITHMS like the CLI's; ValueError otherwise. """
+        algorithm = req.get("algorithm", "ahash")
+        if algorithm not in core.QUERY_ALGORITHMS:
+            raise ValueError(f"Unknown algorithm {algorithm!r}, expected one of {', '.join(core.QUERY_ALGORITHMS)}")
+        return algorithm
+
+    # --- ENDPOINTS ---
+    def status(self, req=None):
+        return {"rows": len(self.index), "loaded_at": self.index.loaded_at, "pid": os.getpid()}
+
+    def query(self, req):
+        max_dist, top_k = self.limits(req)
+        metadata = {k: req[k] for k in ("text", "seed", "model") if req.get(k) is not None} or None
+        matches = list(core.query(req["folder"], req["ref"], max_dist,
+                                  algorithm=self.algorithm(req), top_k=top_k, metadata=metadata,
+                                  index_only=True, index=self.index, pool=self.pool,
+                                  pool_kind=self.pool_kind, workers=self.workers))
+        return {"matches": matches}
+
+    def batch(self, req):
+        max_dist, top_k = self.limits(req)
+        if not isinstance(req["refs"], list):
+            raise ValueError("refs must be a list")
+        grouped = core.query_batch(req["folder"], req["refs"], max_dist, top_k=top_k, index_only=True, index=self.index,
+                                   pool=self.pool, pool_kind=self.pool_kind, workers=self.workers)
+        return {"results": [{"ref": ref, "error": str(v)} if isinstance(v, ValueError) else {"ref": ref, "matches": v}
+                            for ref, v in grouped.items()]}
+
+    def update(self, req):
+        algorithm = self.algorithm(req)
+        if not isinstance(req["folder"], str) or not os.path.isdir(req["folder"]):
+            raise ValueError(f"Not a folder: {req['folder']}")
+        with self.update_lock:
+            files = core.index_root(req["folder"], pool=self.pool, pool_kind=self.pool_kind, workers=self.workers,
+                                    algorithm=algorithm)
+        self.changed.set()
+        return {"root": req["folder"], "files": files}
+
+class ServiceHandler(BaseHTTPRequestHandler):
+    """ JSON in, JSON out. Bad requests get 400 with {"error": ...}, refused ones 403 or 415. """
+    def refused(self):
+        """
+        Sends 403 and returns True for requests that may come from a web page: any with an
+        Origin header, and any whose Host isn't this server (DNS rebinding).
+        """
+        host, port = self.server.server_address[:2]
+        allowed = {f"{host}:{port}", f"localhost:{port}", f"127.0.0.1:{port}", f"[::1]:{port}"}
+        if port == 80:
+            allowed |= {host, "localhost", "127.0.0.1", "[::1]"}
+        if self.headers.get("Origin") is not None:
+            self.respond(403, {"error": "Requests from web pages are not accepted"})
+        elif self.headers.get("Host", "").lower() not in allowed:
+            self.respond(403, {"error": f"Unexpected Host header: {self.headers.get('Host')}"})
+        else:
+            return False
+        return True
+
+    def do_GET(self):
+        if self.refused():
+            return
+        if self.path == "/status":
+            self.respond(200, self.server.service.status())
+        else:
+            self.respond(404, {"error": f"Unknown endpoint {self.path}"})
+
+    def do_POST(self):
+        if self.refused():
+            return
+        if self.headers.get("Content-Type", "").split(";")[0].strip().lower() != "application/json":
+            self.respond(415, {"error": "Content-Type must be application/json"})
+            return
+        service = self.server.service
+        endpoint = {"/query": service.query, "/batch": service.batch, "/index": service.update}.get(self.path)
+        if not endpoint:
+            self.respond(404, {"error": f"Unknown endpoint {self.path}"})
+            return
+        try:
+            req = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            if not isinstance(req, dict):
+                raise ValueError("the body must be a JSON object")
+            self.respond(200, endpoint(req))
+        except (ValueError, KeyError, TypeError) as e:
+            self.respond(400, {"error": f"Bad request: {e}"})
+        except Exception as e:
+            self.respond(500, {"error": str(e)})
+
+    def respond(self, code, obj):
+        data = json.dumps(obj).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass # Requests are too frequent to log
+
+class ServiceClient:
+    """
+    Thin client for a running QueryService. Raises OSError when the service
+    can't be reached and ValueError when it rejects a request.
+    Relative paths are resolved here, since the service has its own working directory.
+    """
+    def __init__(self, url=SERVICE_URL, timeout=SERVICE_TIMEOUT):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def call(self, endpoint, body=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        req = urllib.request.Request(self.url + endpoint, data=data, headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+                return json.load(resp)
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.load(e).get("error", str(e))
+            except ValueError:
+                message = str(e)
+            raise ValueError(message)
+
+    @staticmethod
+    def local_path(path):
+        if isinstance(path, str) and not os.path.isabs(path) and os.path.exists(path):
+            return os.path.abspath(path)
+        return path
+
+    def status(self):
+        return self.call("/status")
+
+    def query(self, folder, ref, max_dist=core.MATCH_DISTANCE, algorithm="ahash", top_k=None, metadata=None):
+        """ [result dict] like core.query(..., index_only=True). """
+        body = dict(metadata or {}, folder=self.local_path(folder), ref=self.local_path(ref),
+                    max_distance=max_dist, algorithm=algorithm, top_k=top_k)
+        return self.call("/query", body)["matches"]
+
+    def batch(self, folder, refs, max_dist=core.MATCH_DISTANCE, top_k=None):
+        """ {ref: [result dict] or ValueError} like core.query_batch(). """
+        sent = {self.local_path(r): r for r in refs}
+        body = {"folder": self.local_path(folder), "refs": list(sent), "max_distance": max_dist, "top_k": top_k}
+        out = {}
+        for entry in self.call("/batch", body)["results"]:
+            out[sent.get(entry["ref"], entry["ref"])] = ValueError(entry["error"]) if "error" in entry else entry["matches"]
+        return out
+
+    def index(self, folder, algorithm="ahash"):
+        """ Brings the index for folder up to date in the service. Returns the number of images found. """
+        return self.call("/index", {"folder": self.local_path(folder), "algorithm": algorithm})["files"]
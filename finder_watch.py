@@ -0,0 +1,311 @@
+"""
+Background indexer for SourceSeeker: keeps the hash index of every scan root
+warm, so queries find nearly everything already hashed.
+
+Uses inotify on Linux and falls back to polling elsewhere (or when inotify
+is unavailable or out of watches). Changed directories are collected until
+things settle down for WATCH_DEBOUNCE seconds, then rescanned incrementally
+with finder_core.Scanner on a small, low-priority hash pool. Only the
+directories that changed are relisted; files that vanished are pruned on
+the way. Run it with `finder_cli.py watch`, or enable it in the app.
+"""
+import os
+import sys
+import time
+import errno
+import signal
+import struct
+import select
+import ctypes
+import ctypes.util
+import multiprocessing
+
+import finder_core as core
+
+# --- CONFIGURATION ---
+
+# Changes are batched until no event arrived for WATCH_DEBOUNCE seconds,
+# but never held back for longer than WATCH_MAX_DELAY (e.g. during a long copy).
+WATCH_DEBOUNCE = 2.0
+WATCH_MAX_DELAY = 30.0
+
+# Polling fallback: every scan root is rescanned incrementally (one stat per
+# directory) this often. Also how often new scan roots are picked up.
+WATCH_POLL_SECONDS = 60.0
+
+# Hashing runs on its own pool of WATCH_WORKERS, whose worker processes get this nice()
+# increment (POSIX only), so the machine stays responsive while a large import is indexed.
+# `finder_cli.py watch` lowers its own priority too; the app's threads are left alone,
+# since on most platforms nice() applies to the whole process, UI included.
+WATCH_WORKERS = 1
+WATCH_NICE = 10
+
+# Set to False to always poll
+WATCH_INOTIFY = True
+
+# inotify event bits (linux/inotify.h)
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+# Events that only take something away from a directory; such directories are rescanned
+# last, so a file moved elsewhere is found at its new path before its old row is pruned.
+REMOVAL_EVENTS = IN_MOVED_FROM | IN_DELETE
+
+def lower_priority():
+    """ Lowers the CPU priority of the calling process (on Linux, only the calling thread). """
+    try:
+        os.nice(WATCH_NICE)
+    except (AttributeError, OSError):
+        pass
+
+def init_watch_worker():
+    """ Hash pool initializer: low priority for worker processes, and Ctrl+C is left to the watcher to handle. """
+    if multiprocessing.parent_process() is not None:
+        lower_priority() # Not in a thread pool, whose threads belong to the app
+    try:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+    except ValueError:
+        pass # Thread pool: signals belong to the main thread anyway
+
+class Inotify:
+    """ Minimal ctypes binding to Linux inotify, watching directories. Raises OSError if unavailable. """
+    EVENT = struct.Struct("iIII") # wd, mask, cookie, len; the name follows
+
+    def __init__(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            self.init1 = libc.inotify_init1
+            self.add_watch = libc.inotify_add_watch
+            self.rm_watch = libc.inotify_rm_watch
+        except AttributeError:
+            raise OSError("C library without inotify")
+        self.add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = self.init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.paths = {} # wd -> directory path
+        self.wds = {} # directory path -> wd
+
+    def watch(self, path):
+        """ Watches a directory. False if it is gone; OSError once the watch limit is reached. """
+        if path in self.wds:
+            return True
+        wd = self.add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise OSError(err, "Out of inotify watches (raise fs.inotify.max_user_watches)")
+            return False
+        self.paths[wd] = path
+        self.wds[path] = wd
+        return True
+
+    def forget(self, path):
+        """ Drops the watches of a directory and everything below it (after it was moved or deleted). """
+        lo, hi = core.subtree_range(path)
+        for p in [p for p in self.wds if p == path or lo <= p < hi]:
+            wd = self.wds.pop(p)
+            self.paths.pop(wd, None)
+            self.rm_watch(self.fd, wd)
+
+    def read(self, timeout):
+        """ [(directory, name, mask)] of the events that arrive within `timeout` seconds. """
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            data = os.read(self.fd, 256 * 1024)
+        except BlockingIOError:
+            return []
+        events, pos = [], 0
+        while pos + self.EVENT.size <= len(data):
+            wd, mask, cookie, length = self.EVENT.unpack_from(data, pos)
+            name = os.fsdecode(data[pos + self.EVENT.size:pos + self.EVENT.size + length].rstrip(b"\0"))
+            pos += self.EVENT.size + length
+            path = self.paths.get(wd)
+            if mask & IN_IGNORED:
+                # The kernel removed the watch (directory deleted or unmounted)
+                self.paths.pop(wd, None)
+                if path is not None and self.wds.get(path) == wd:
+                    del self.wds[path]
+            elif path is not None or mask & IN_Q_OVERFLOW:
+                events.append((path, name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+class IndexWatcher:
+    """
+    Keeps the index of every root in scan_roots up to date until stop() is called.
+    run() blocks, so the app runs it on a thread of its own. Starts with an incremental
+    scan of each root to catch up with changes made while nothing was watching.
+    Progress goes to on_status("status", text).
+    """
+    def __init__(self, on_status=None, pool_kind=core.HASH_POOL, workers=WATCH_WORKERS, use_inotify=WATCH_INOTIFY):
+        self.on_status = on_status or (lambda kind, data: None)
+        self.pool_kind = pool_kind
+        self.workers = workers
+        self.use_inotify = use_inotify
+        self.inotify = None
+        self.roots = []
+        self.dirty = {} # directory -> True if it only lost entries
+        self.first_change = self.last_change = None
+        self.scanner = None
+        self.is_running = True
+
+    def load_roots(self):
+        """ Existing scan roots, without those nested in another root. """
+        conn = core.connect_db()
+        try:
+            paths = sorted(r[0] for r in conn.execute("SELECT path FROM scan_roots"))
+        finally:
+            conn.close()
+        roots = []
+        for path in paths:
+            if os.path.isdir(path) and not any(path.startswith(core.subtree_range(r)[0]) for r in roots):
+                roots.append(path)
+        return roots
+
+    def mark(self, path, removal=False):
+        now = time.time()
+        self.dirty[path] = self.dirty.get(path, True) and removal
+        if self.first_change is None:
+            self.first_change = now
+        self.last_change = now
+
+    def watch_tree(self, folder, mark=True):
+        """
+        Adds watches for the indexed directories under folder that have none yet. With `mark`,
+        those are rescanned once more: files created before the watch existed would otherwise
+        go unnoticed.
+        """
+        conn = core.connect_db()
+        try:
+            lo, hi = core.subtree_range(folder)
+            paths = [r[0] for r in conn.execute("SELECT path FROM directories WHERE path = ? OR (path >= ? AND path < ?)",
+                                                (folder, lo, hi))]
+        finally:
+            conn.close()
+        for path in paths:
+            if path not in self.inotify.wds and self.inotify.watch(path) and mark:
+                self.mark(path)
+
+    def update_roots(self):
+        roots = self.load_roots()
+        for root in roots:
+            if root not in self.roots:
+                self.mark(root)
+                if self.inotify:
+                    self.watch_tree(root, mark=False)
+        if self.inotify:
+            for root in self.roots:
+                if root not in roots:
+                    self.inotify.forget(root)
+        self.roots = roots
+
+    def handle(self, events):
+        for dir_path, name, mask in events:
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost: fall back to an incremental rescan of everything
+                for root in self.roots:
+                    self.mark(root)
+                continue
+            is_dir = mask & IN_ISDIR
+            if not is_dir and os.path.splitext(name)[1].lower() not in core.IMAGE_EXTENSIONS:
+                continue
+            if is_dir and mask & REMOVAL_EVENTS:
+                self.inotify.forget(os.path.join(dir_path, name))
+            self.mark(dir_path, removal=bool(mask & REMOVAL_EVENTS))
+
+    def refresh(self):
+        """ Rescans the directories changed since the last refresh. """
+        dirty, self.dirty = self.dirty, {}
+        self.first_change = self.last_change = None
+        conn = core.connect_db()
+        try:
+            # NULL mtime = relist: a file rewritten in place leaves its directory's mtime alone
+            conn.executemany("UPDATE directories SET mtime = NULL WHERE path = ?", [(d,) for d in dirty])
+            conn.commit()
+        finally:
+            conn.close()
+
+        # A directory's rescan covers every dirty directory below it
+        folders = []
+        for path in sorted(dirty):
+            if not any(path == f or path.startswith(core.subtree_range(f)[0]) for f in folders):
+                folders.append(path)
+        folders.sort(key=lambda f: dirty[f])
+        for folder in folders:
+            if not self.is_running:
+                break
+            if not os.path.isdir(folder):
+                continue # Its parent's listing prunes it
+            start = time.time()
+            self.scanner = core.Scanner(folder, pool=self.pool, register=False, workers=self.workers)
+            for _ in self.scanner.run():
+                pass
+            counters = self.scanner.stats.snapshot()["counters"]
+            if counters.get("hashed") or counters.get("reused"):
+                self.on_status("status", f"Index updated: {folder} ({counters.get('hashed', 0)} hashed, "
+                                         f"{time.time() - start:.1f}s)")
+            if self.inotify:
+                self.watch_tree(folder)
+        self.scanner = None
+
+    def run(self):
+        if self.use_inotify and sys.platform.startswith("linux"):
+            try:
+                self.inotify = Inotify()
+            except OSError as e:
+                self.on_status("status", f"Watcher: inotify unavailable ({e}), polling every {WATCH_POLL_SECONDS:.0f}s")
+        self.pool = core.make_hash_pool(self.pool_kind, self.workers, initializer=init_watch_worker)
+        last_poll = 0
+        try:
+            while self.is_running:
+                if time.time() - last_poll >= WATCH_POLL_SECONDS:
+                    last_poll = time.time()
+                    try:
+                        self.update_roots()
+                    except OSError as e:
+                        self.stop_inotify(e)
+                    if not self.inotify:
+                        for root in self.roots:
+                            self.mark(root)
+
+                if self.inotify:
+                    self.handle(self.inotify.read(0.5))
+                else:
+                    time.sleep(0.5)
+
+                now = time.time()
+                if self.dirty and (now - self.last_change >= WATCH_DEBOUNCE or now - self.first_change >= WATCH_MAX_DELAY):
+                    try:
+                        self.refresh()
+                    except OSError as e:
+                        self.stop_inotify(e)
+                    except Exception as e:
+                        self.on_status("status", f"Watcher error: {e}")
+        finally:
+            self.pool.shutdown(wait=False)
+            if self.inotify:
+                self.inotify.close()
+
+    def stop_inotify(self, error):
+        """ Switches to polling, e.g. once the inotify watch limit is reached. """
+        if self.inotify:
+            self.on_status("status", f"Watcher: {error}; polling every {WATCH_POLL_SECONDS:.0f}s instead")
+            self.inotify.close()
+            self.inotify = None
+
+    def stop(self):
+        self.is_running = False
+        if self.scanner:
+            self.scanner.stop()
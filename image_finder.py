@@ -1,13 +1,16 @@
 import os
 import sys
 import sqlite3
-import hashlib
 import json
 import threading
 import queue
 import platform
 import subprocess
-import re
+import io
+import collections
+import csv
+import time
+import multiprocessing
 from datetime import datetime
 
 import tkinter as tk
@@ -15,7 +18,14 @@ from tkinter import ttk, filedialog, messagebox, scrolledtext
 from tkinter import Menu
 
 from PIL import Image, ImageTk, ExifTags, ImageGrab
-import imagehash
+
+import finder_core
+from finder_watch import IndexWatcher
+from finder_service import ServiceClient
+from finder_core import (HASH_POOL, HASH_WORKERS, MATCH_DISTANCE, QUERY_ALGORITHMS, connect_db, init_db,
+                         folder_counts, subtree_range, resolve_ref_hashes, Scanner, ScanStats, format_stats,
+                         find_near_duplicates, search_metadata, parse_metadata_query, lookup_generation_info,
+                         read_generation_info, read_image_text, HashIndex)
 
 # --- OPTIONAL DRAG & DROP SUPPORT ---
 try:
@@ -26,10 +36,32 @@ except ImportError:
     print("Note: Install 'tkinterdnd2' to enable Drag & Drop support (pip install tkinterdnd2)")
 
 # --- CONFIGURATION ---
-DB_NAME = "image_hashes.db"
 CONFIG_FILE = "config.json"
 ICON_NAME = "app_icon.ico"
 
+# Result thumbnails are cached as compressed blobs in a sidecar database keyed by
+# path + mtime, and the least recently used ones are evicted past THUMB_CACHE_MB.
+THUMB_DB_NAME = "thumbnails.db"
+THUMB_SIZE = (50, 50)
+THUMB_CACHE_MB = 64
+
+# Results view: rows are inserted within RESULT_BATCH_MS per UI tick, and thumbnails
+# only exist for the visible rows plus THUMB_MARGIN rows around them.
+RESULT_BATCH_MS = 25
+THUMB_MARGIN = 10
+# Metadata-only searches list at most this many images
+METADATA_RESULTS = 5000
+
+# Metadata panel: formatted text of the last METADATA_CACHE_SIZE selections is kept
+# (keyed by path + mtime); only the first METADATA_DISPLAY_CHARS are put in the widget,
+# "Copy All" still copies everything.
+METADATA_CACHE_SIZE = 200
+METADATA_DISPLAY_CHARS = 100_000
+
+# "Match by" choices (finder_core.QUERY_ALGORITHMS)
+ALGORITHM_LABELS = {"ahash": "aHash (fastest)", "phash": "pHash (stricter)", "dhash": "dHash",
+                    "whash": "wHash", "colorhash": "Color hash", "cascade": "aHash, then pHash"}
+
 # Dark Theme Colors
 COLOR_BG = "#2b2b2b"
 COLOR_FG = "#ffffff"
@@ -38,6 +70,12 @@ COLOR_ACCENT_HOVER = "#45a049"
 COLOR_LIST_BG = "#363636"
 COLOR_LIST_FG = "#eeeeee"
 
+def open_path(path):
+    """ Opens a file with the system's default application. """
+    if platform.system() == 'Darwin': subprocess.call(('open', path))
+    elif platform.system() == 'Windows': os.startfile(path)
+    else: subprocess.call(('xdg-open', path))
+
 def resource_path(relative_path):
     """ Get absolute path to resource, works for dev and for PyInstaller """
     try:
@@ -47,17 +85,150 @@ def resource_path(relative_path):
 
     return os.path.join(base_path, relative_path)
 
-def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    c = conn.cursor()
-    # File hashes table
-    c.execute('''CREATE TABLE IF NOT EXISTS files 
-                 (path TEXT PRIMARY KEY, mtime REAL, p_hash TEXT)''')
-    # Roots table to track scan sessions for grouping
-    c.execute('''CREATE TABLE IF NOT EXISTS scan_roots 
-                 (path TEXT PRIMARY KEY)''')
-    conn.commit()
-    conn.close()
+def make_thumbnail(path, size=THUMB_SIZE):
+    """ Returns compressed thumbnail bytes (JPEG, or PNG when there is transparency). """
+    with Image.open(path) as img:
+        img.thumbnail(size) # Uses draft()/reduce() internally, so large JPEGs decode at reduced size
+        buf = io.BytesIO()
+        if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+            img.convert("RGBA").save(buf, "PNG")
+        else:
+            img.convert("RGB").save(buf, "JPEG", quality=85)
+        return buf.getvalue()
+
+class ThumbnailCache:
+    """
+    Size-bounded LRU store of thumbnail blobs in THUMB_DB_NAME, keyed by path + mtime.
+    Not thread-safe: owned by the ThumbnailLoader thread.
+    """
+    def __init__(self, db_name=THUMB_DB_NAME, max_bytes=THUMB_CACHE_MB * 1024 * 1024):
+        self.conn = sqlite3.connect(db_name, timeout=30)
+        self.conn.execute("PRAGMA journal_mode = WAL")
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS thumbs 
+                             (path TEXT PRIMARY KEY, mtime REAL, data BLOB, size INTEGER, last_used REAL)''')
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_thumbs_used ON thumbs (last_used)")
+        self.conn.commit()
+        self.max_bytes = max_bytes
+        self.total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM thumbs").fetchone()[0]
+
+    def get(self, path, mtime):
+        row = self.conn.execute("SELECT mtime, data FROM thumbs WHERE path = ?", (path,)).fetchone()
+        if not row or row[0] != mtime:
+            return None
+        self.conn.execute("UPDATE thumbs SET last_used = ? WHERE path = ?", (time.time(), path))
+        self.conn.commit()
+        return row[1]
+
+    def put(self, path, mtime, data):
+        old = self.conn.execute("SELECT size FROM thumbs WHERE path = ?", (path,)).fetchone()
+        self.conn.execute("INSERT OR REPLACE INTO thumbs (path, mtime, data, size, last_used) VALUES (?, ?, ?, ?, ?)",
+                          (path, mtime, data, len(data), time.time()))
+        self.total += len(data) - (old[0] if old else 0)
+        if self.total > self.max_bytes:
+            self.evict()
+        self.conn.commit()
+
+    def evict(self):
+        """ Drops least recently used thumbnails until the cache is back under 90% of its limit. """
+        target = self.max_bytes * 0.9
+        victims = []
+        for path, size in self.conn.execute("SELECT path, size FROM thumbs ORDER BY last_used"):
+            if self.total <= target: break
+            victims.append((path,))
+            self.total -= size
+        self.conn.executemany("DELETE FROM thumbs WHERE path = ?", victims)
+
+class ThumbnailLoader(threading.Thread):
+    """
+    Builds result thumbnails off the UI thread. Requests are (key, path);
+    finished thumbnails come back on out_queue as (key, bytes) for the UI
+    thread to turn into PhotoImages. Requests from an older generation
+    (e.g. a previous scan) are skipped. Build time goes to `stats` (the
+    current scan's ScanStats) as the "thumbnail" phase.
+    """
+    def __init__(self, out_queue):
+        super().__init__()
+        self.daemon = True
+        self.requests = queue.Queue()
+        self.out_queue = out_queue
+        self.generation = 0
+        self.stats = ScanStats()
+
+    def request(self, key, path):
+        self.requests.put((self.generation, key, path))
+
+    def reset(self):
+        self.generation += 1
+
+    def run(self):
+        cache = ThumbnailCache()
+        while True:
+            generation, key, path = self.requests.get()
+            if generation != self.generation:
+                continue
+            try:
+                mtime = os.path.getmtime(path)
+                data = cache.get(path, mtime)
+                if data is None:
+                    with self.stats.phase("thumbnail"):
+                        data = make_thumbnail(path)
+                    cache.put(path, mtime, data)
+                self.out_queue.put((key, data))
+            except Exception:
+                pass
+
+def format_metadata(path):
+    """ Text for the metadata panel, from read_image_text(); JSON values (ComfyUI graphs) are pretty-printed. """
+    fmt, size, text = read_image_text(path)
+    output = [f"Format: {fmt} | Size: {size}\n" + "-"*40]
+    for k, v in text.items():
+        if k in ['prompt', 'workflow', 'parameters']:
+            try:
+                if v.startswith('{') or v.startswith('['):
+                    v = json.dumps(json.loads(v), indent=2)
+            except Exception: pass
+            output.append(f"\n[{k}]:\n{v}")
+        else:
+            output.append(f"[{k}]: {v}")
+    return "\n".join(output)
+
+class MetadataLoader(threading.Thread):
+    """
+    Reads and formats the metadata of the selected result off the UI thread.
+    Finished text comes back on out_queue as (path, text); only the newest
+    request is served. Keeps an LRU of METADATA_CACHE_SIZE formatted texts
+    keyed by path + mtime, so going back to a result is instant.
+    """
+    def __init__(self, out_queue):
+        super().__init__()
+        self.daemon = True
+        self.requests = queue.Queue()
+        self.out_queue = out_queue
+        self.generation = 0
+        self.cache = collections.OrderedDict()
+
+    def request(self, path):
+        self.generation += 1
+        self.requests.put((self.generation, path))
+
+    def run(self):
+        while True:
+            generation, path = self.requests.get()
+            if generation != self.generation:
+                continue
+            try:
+                key = (path, os.path.getmtime(path))
+                text = self.cache.get(key)
+                if text is None:
+                    text = format_metadata(path)
+                    self.cache[key] = text
+                    if len(self.cache) > METADATA_CACHE_SIZE:
+                        self.cache.popitem(last=False)
+                else:
+                    self.cache.move_to_end(key)
+            except Exception as e:
+                text = f"Error: {e}"
+            self.out_queue.put((path, text))
 
 class CacheManager(tk.Toplevel):
     """
@@ -131,59 +302,39 @@ class CacheManager(tk.Toplevel):
         # Clear tree
         for item in self.tree.get_children():
             self.tree.delete(item)
+        self.tree.insert("", "end", values=("Loading...", "", ""))
+
+        # Counting runs off the UI thread so the window opens instantly on large indexes
+        self.load_queue = queue.Queue()
+        threading.Thread(target=self.count_groups, args=(self.load_queue,), daemon=True).start()
+        self.after(50, self.check_load)
 
+    def count_groups(self, out):
         try:
-            conn = sqlite3.connect(DB_NAME)
-            c = conn.cursor()
-            
-            # 1. Load registered Scan Roots
-            c.execute("SELECT path FROM scan_roots")
-            # Store roots as (original, normalized) for robust matching
-            roots = []
-            is_win = platform.system() == "Windows"
-            for r in c.fetchall():
-                path = r[0]
-                norm = os.path.normpath(path).lower() if is_win else os.path.normpath(path)
-                roots.append((path, norm))
-            
-            # 2. Load all file paths
-            c.execute("SELECT path FROM files")
-            all_files = c.fetchall()
-            
+            conn = connect_db()
+            groups = folder_counts(conn)
             conn.close()
+            out.put(groups)
+        except Exception as e:
+            out.put(e)
 
-            # 3. Group files
-            groups = {} # folder_path -> count
-
-            for row in all_files:
-                f_path = row[0]
-                f_norm = os.path.normpath(f_path).lower() if is_win else os.path.normpath(f_path)
-                
-                matched_root = None
-                best_len = -1
-                
-                # Try to find a registered root that contains this file
-                for r_orig, r_norm in roots:
-                    # Check if file is inside root (exact match or subdirectory)
-                    if f_norm == r_norm or f_norm.startswith(r_norm + os.sep):
-                        if len(r_norm) > best_len:
-                            matched_root = r_orig
-                            best_len = len(r_norm)
-                
-                if matched_root:
-                    groups[matched_root] = groups.get(matched_root, 0) + 1
-                else:
-                    # Legacy data / Uncategorized: Group by immediate parent folder
-                    parent = os.path.dirname(f_path)
-                    groups[parent] = groups.get(parent, 0) + 1
+    def check_load(self):
+        try:
+            groups = self.load_queue.get_nowait()
+        except queue.Empty:
+            self.after(50, self.check_load)
+            return
 
-            # 4. Display
-            for folder in sorted(groups.keys()):
-                status = "Found" if os.path.exists(folder) else "Missing"
-                self.tree.insert("", "end", values=(folder, groups[folder], status))
+        for item in self.tree.get_children():
+            self.tree.delete(item)
+        if isinstance(groups, Exception):
+            messagebox.showerror("Error", f"Failed to load cache: {groups}")
+            return
 
-        except Exception as e:
-            messagebox.showerror("Error", f"Failed to load cache: {e}")
+        # Display
+        for folder in sorted(groups.keys()):
+            status = "Found" if os.path.exists(folder) else "Missing"
+            self.tree.insert("", "end", values=(folder, groups[folder], status))
 
     def delete_selected(self):
         selected_items = self.tree.selection()
@@ -195,21 +346,23 @@ class CacheManager(tk.Toplevel):
         if not confirm:
             return
 
-        conn = sqlite3.connect(DB_NAME)
+        conn = connect_db()
         c = conn.cursor()
         
         try:
             for item in selected_items:
                 vals = self.tree.item(item, 'values')
                 folder_path = vals[0]
+                lo, hi = subtree_range(folder_path)
                 
-                # 1. Remove files from index
-                # Pattern: folder itself OR folder + separator + wildcard
-                pattern = os.path.join(folder_path, "%")
-                c.execute("DELETE FROM files WHERE path LIKE ?", (pattern,))
+                # 1. Remove files from index (primary key range: folder itself OR anything below it)
+                c.execute("DELETE FROM files WHERE path >= ? AND path < ?", (lo, hi))
                 c.execute("DELETE FROM files WHERE path = ?", (folder_path,))
+
+                # 2. Remove the directory subtree
+                c.execute("DELETE FROM directories WHERE path = ? OR (path >= ? AND path < ?)", (folder_path, lo, hi))
                 
-                # 2. Remove from roots registry (if it was a root)
+                # 3. Remove from roots registry (if it was a root)
                 c.execute("DELETE FROM scan_roots WHERE path = ?", (folder_path,))
             
             conn.commit()
@@ -221,152 +374,300 @@ class CacheManager(tk.Toplevel):
         finally:
             conn.close()
 
-class ImageScanner(threading.Thread):
+class NearDuplicates(tk.Toplevel):
     """
-    Background thread to scan folders and hash images.
+    Window listing every cluster of near-duplicate images in the index (or below the
+    selected folder), largest first, with export to CSV or JSON.
+    Clustering runs on a background thread; members are only inserted when a cluster is expanded.
     """
-    def __init__(self, folder_path, input_image_path, result_queue, status_queue):
-        super().__init__()
-        self.folder_path = folder_path
-        self.input_image_path = input_image_path
-        self.result_queue = result_queue
-        self.status_queue = status_queue
-        self.is_running = True
-        self.daemon = True 
+    def __init__(self, parent, folder=""):
+        super().__init__(parent)
+        self.title("Near Duplicates")
+        self.geometry("800x650")
+        self.configure(bg=COLOR_BG)
+        self.folder = folder
+        self.clusters = {} # tree item -> cluster dict
+        self.cluster_list = []
+        self.pending = collections.deque()
+        self.worker = None
+        self.stopped = False
+        self.queue = queue.Queue()
+
+        lbl_info = tk.Label(self, text="Near-Duplicate Clusters", font=("Segoe UI", 12, "bold"), bg=COLOR_BG, fg=COLOR_FG)
+        lbl_info.pack(pady=10)
 
-    def calculate_hash(self, image_path):
-        try:
-            img = Image.open(image_path)
-            # Average Hash (aHash) - Best for finding sources/screenshots
-            h = str(imagehash.average_hash(img))
-            return h
-        except Exception:
-            return None
+        hint_text = (
+            "Groups images whose hashes are within the distance of each other (transitively).\n"
+            "Expand a cluster to see its images; double-click to open one."
+        )
+        tk.Label(self, text=hint_text, bg=COLOR_BG, fg="#aaaaaa", justify=tk.CENTER).pack(pady=(0, 10))
+
+        # --- OPTIONS ---
+        frame_opts = tk.Frame(self, bg=COLOR_BG)
+        frame_opts.pack(fill=tk.X, padx=10)
+        self.only_folder = tk.BooleanVar(value=bool(folder))
+        tk.Checkbutton(frame_opts, text=f"Only {folder}" if folder else "Only selected folder", variable=self.only_folder,
+                       state=tk.NORMAL if folder else tk.DISABLED, bg=COLOR_BG, fg=COLOR_FG,
+                       selectcolor="#444444", activebackground=COLOR_BG).pack(side=tk.LEFT)
+        self.max_dist = tk.IntVar(value=MATCH_DISTANCE)
+        # Up to the largest distance the substring join covers; beyond it every hash meets every other
+        self.dist_limit = HashIndex.MAX_RADIUS * 4 + 3
+        tk.Spinbox(frame_opts, from_=0, to=self.dist_limit, width=4, textvariable=self.max_dist).pack(side=tk.RIGHT)
+        tk.Label(frame_opts, text="Max distance:", bg=COLOR_BG, fg=COLOR_FG).pack(side=tk.RIGHT, padx=5)
 
-    def run(self):
-        if not self.folder_path or not self.input_image_path:
+        # --- TREEVIEW & SCROLLBAR ---
+        frame_list = tk.Frame(self, bg=COLOR_BG)
+        frame_list.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+        columns = ("Distance", "Path")
+        self.tree = ttk.Treeview(frame_list, columns=columns, show='tree headings', selectmode="browse")
+        self.tree.heading("#0", text="Cluster", anchor=tk.W)
+        self.tree.heading("Distance", text="Distance", anchor=tk.CENTER)
+        self.tree.heading("Path", text="Path", anchor=tk.W)
+        self.tree.column("#0", width=160, stretch=False)
+        self.tree.column("Distance", width=70, anchor=tk.CENTER, stretch=False)
+        self.tree.column("Path", width=500, stretch=True)
+
+        vsb = ttk.Scrollbar(frame_list, orient="vertical", command=self.tree.yview)
+        self.tree.configure(yscrollcommand=vsb.set)
+        vsb.pack(side=tk.RIGHT, fill=tk.Y)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        self.tree.bind("<<TreeviewOpen>>", self.on_open)
+        self.tree.bind("<Double-1>", self.on_double_click)
+
+        # --- STATUS ---
+        frame_status = tk.Frame(self, bg=COLOR_BG)
+        frame_status.pack(fill=tk.X, padx=10)
+        self.lbl_status = tk.Label(frame_status, text="Ready", bg=COLOR_BG, fg="#aaaaaa")
+        self.lbl_status.pack(side=tk.LEFT)
+        self.progress = ttk.Progressbar(frame_status, orient=tk.HORIZONTAL, length=200, mode='determinate')
+        self.progress.pack(side=tk.RIGHT)
+
+        # --- BUTTONS (Stacked) ---
+        frame_btn = tk.Frame(self, bg=COLOR_BG)
+        frame_btn.pack(fill=tk.X, padx=10, pady=15)
+
+        self.btn_run = tk.Button(frame_btn, text="Find Clusters", command=self.toggle_run,
+                                 bg=COLOR_ACCENT, fg="white", relief=tk.FLAT, padx=10, pady=5)
+        self.btn_run.pack(fill=tk.X, pady=(0, 5))
+
+        btn_export = tk.Button(frame_btn, text="Export...", command=self.export,
+                               bg="#444444", fg="white", relief=tk.FLAT, padx=10, pady=5)
+        btn_export.pack(fill=tk.X)
+
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+
+    def toggle_run(self):
+        if self.worker and self.worker.is_alive():
+            self.stopped = True
+            self.btn_run.config(text="Stopping...", state=tk.DISABLED)
             return
 
-        conn = sqlite3.connect(DB_NAME)
-        c = conn.cursor()
-        
-        # --- NEW: Register Scan Root for Grouping ---
+        for item in self.tree.get_children():
+            self.tree.delete(item)
+        self.clusters = {}
+        self.cluster_list = []
+        self.pending.clear()
+        self.stopped = False
         try:
-            c.execute("INSERT OR IGNORE INTO scan_roots (path) VALUES (?)", (self.folder_path,))
-            conn.commit()
-        except Exception:
-            pass
+            max_dist = min(max(self.max_dist.get(), 0), self.dist_limit)
+        except tk.TclError:
+            max_dist = MATCH_DISTANCE
+        self.max_dist.set(max_dist)
+        folder = self.folder if self.only_folder.get() else None
+        self.worker = threading.Thread(target=self.run_clustering, args=(folder, max_dist), daemon=True)
+        self.worker.start()
+        self.btn_run.config(text="Stop", bg="#D32F2F")
+        self.after(100, self.check_queue)
 
-        self.status_queue.put(("status", "Calculating input hash..."))
-        input_hash = self.calculate_hash(self.input_image_path)
-        
-        if not input_hash:
-            self.status_queue.put(("status", "Error: Could not read input image."))
-            self.status_queue.put(("done", None))
-            conn.close()
+    def run_clustering(self, folder, max_dist):
+        try:
+            for cluster in find_near_duplicates(folder, max_dist, on_status=lambda k, d: self.queue.put((k, d)),
+                                                should_stop=lambda: self.stopped):
+                if self.stopped: break
+                self.queue.put(("cluster", cluster))
+        except Exception as e:
+            self.queue.put(("status", f"Error: {e}"))
+        self.queue.put(("done", None))
+
+    def check_queue(self):
+        done = False
+        try:
+            while True:
+                kind, data = self.queue.get_nowait()
+                if kind == "status": self.lbl_status.config(text=data)
+                elif kind == "progress": self.progress['value'] = data
+                elif kind == "cluster": self.pending.append(data)
+                elif kind == "done": done = True
+        except queue.Empty: pass
+
+        # Insert within RESULT_BATCH_MS per tick, like the main results view
+        deadline = time.perf_counter() + RESULT_BATCH_MS / 1000
+        while self.pending and time.perf_counter() < deadline:
+            cluster = self.pending.popleft()
+            first = cluster["members"][0]["path"]
+            item = self.tree.insert("", "end", text=f"#{cluster['id']} ({cluster['count']} images)",
+                                    values=("", first))
+            self.tree.insert(item, "end", text="...") # Placeholder so the cluster can be expanded
+            self.clusters[item] = cluster
+            self.cluster_list.append(cluster)
+
+        if done and not self.pending:
+            self.btn_run.config(text="Find Clusters", bg=COLOR_ACCENT, state=tk.NORMAL)
+            if self.stopped: self.lbl_status.config(text=f"Stopped ({len(self.cluster_list)} clusters listed)")
             return
+        self.after(10 if self.pending else 100, self.check_queue)
+
+    def on_open(self, event):
+        item = self.tree.focus()
+        cluster = self.clusters.get(item)
+        if not cluster: return
+        self.tree.delete(*self.tree.get_children(item))
+        for m in cluster["members"]:
+            self.tree.insert(item, "end", text=os.path.basename(m["path"]), values=(m["distance"], m["path"]))
+        self.clusters.pop(item) # Members are inserted once
+
+    def on_double_click(self, event):
+        item = self.tree.identify_row(event.y)
+        if item and self.tree.parent(item):
+            path = self.tree.item(item, 'values')[1]
+            try:
+                open_path(path)
+            except Exception as e:
+                messagebox.showerror("Error", f"Could not open file: {e}", parent=self)
 
-        # --- OPTIMIZATION: Preload DB Cache ---
-        self.status_queue.put(("status", "Loading cache into memory..."))
-        db_cache = {}
+    def export(self):
+        if not self.cluster_list:
+            messagebox.showinfo("Info", "No clusters to export.", parent=self)
+            return
+        path = filedialog.asksaveasfilename(parent=self, defaultextension=".csv",
+                                            filetypes=[("CSV", "*.csv"), ("JSON", "*.json")])
+        if not path: return
         try:
-            c.execute("SELECT path, mtime, p_hash FROM files")
-            rows = c.fetchall()
-            for r in rows:
-                db_cache[r[0]] = (r[1], r[2])
+            if path.lower().endswith(".json"):
+                with open(path, "w", encoding="utf-8") as f:
+                    json.dump(self.cluster_list, f, indent=2)
+            else:
+                with open(path, "w", newline="", encoding="utf-8") as f:
+                    writer = csv.writer(f)
+                    writer.writerow(["cluster", "distance", "path"])
+                    for cluster in self.cluster_list:
+                        for m in cluster["members"]:
+                            writer.writerow([cluster["id"], m["distance"], m["path"]])
+            self.lbl_status.config(text=f"Exported {len(self.cluster_list)} clusters to {os.path.basename(path)}")
         except Exception as e:
-            print(f"Cache load error: {e}")
-            db_cache = {}
-
-        image_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.webp', '.tiff'}
-        files_to_process = []
+            messagebox.showerror("Error", f"Export failed: {e}", parent=self)
 
-        # 1. Discovery Phase
-        self.status_queue.put(("status", "Scanning directory..."))
-        count_found = 0
-        for root, dirs, files in os.walk(self.folder_path):
-            if not self.is_running: break
-            for file in files:
-                if os.path.splitext(file)[1].lower() in image_extensions:
-                    full_path = os.path.join(root, file)
-                    files_to_process.append(full_path)
-                    count_found += 1
-                    
-                    if count_found % 500 == 0:
-                         self.status_queue.put(("status", f"Found {count_found} files..."))
-
-        total_files = len(files_to_process)
-        
-        # 2. Match Phase
-        self.status_queue.put(("status", f"Processing {total_files} images..."))
-        
-        batch_counter = 0
-        ref_hash_obj = imagehash.hex_to_hash(input_hash)
+    def on_close(self):
+        self.stopped = True
+        self.destroy()
 
-        for index, file_path in enumerate(files_to_process):
-            if not self.is_running: break
-            
-            try:
-                try:
-                    mtime = os.path.getmtime(file_path)
-                except FileNotFoundError:
-                    continue 
-                
-                file_hash_str = None
-                
-                # Check Memory Cache
-                if file_path in db_cache:
-                    cached_mtime, cached_hash = db_cache[file_path]
-                    if cached_mtime == mtime:
-                        file_hash_str = cached_hash
-                
-                # Calculate if missing or changed
-                if not file_hash_str:
-                    file_hash_str = self.calculate_hash(file_path)
-                    if file_hash_str:
-                        # Write to DB
-                        c.execute("INSERT OR REPLACE INTO files (path, mtime, p_hash) VALUES (?, ?, ?)",
-                                  (file_path, mtime, file_hash_str))
-                        batch_counter += 1
-
-                # Compare
-                if file_hash_str:
-                    dist = ref_hash_obj - imagehash.hex_to_hash(file_hash_str)
-                    
-                    if dist <= 5: 
-                        file_stat = os.stat(file_path)
-                        size_mb = file_stat.st_size / (1024 * 1024)
-                        
-                        result_data = {
-                            "path": file_path,
-                            "name": os.path.basename(file_path),
-                            "size": f"{size_mb:.2f} MB",
-                            "distance": dist
-                        }
-                        self.result_queue.put(result_data)
+class ImageScanner(threading.Thread):
+    """
+    Background thread that runs a core Scanner and reports through the UI queues.
+    With top_k, the best top_k matches arrive ranked once the scan is done.
+    With index_only, matches come from the index first; with `reconcile` a normal
+    scan follows and adds any match the index did not know about yet (not with top_k,
+    whose ranked list is final once shown).
+    ("done", None) is always posted last, whatever happened.
+    With a `service` URL, a running finder_service answers instead, if it can be reached.
+    """
+    def __init__(self, folder_path, input_image_path, result_queue, status_queue,
+                 pool_kind=HASH_POOL, workers=HASH_WORKERS, algorithm="ahash",
+                 max_dist=MATCH_DISTANCE, top_k=None, stats=None, profile=None, metadata=None,
+                 index_only=False, reconcile=True, service=None):
+        super().__init__()
+        self.folder_path = folder_path
+        self.input_image_path = input_image_path
+        self.algorithm = algorithm
+        self.max_dist = max_dist
+        self.top_k = top_k
+        self.stats = stats
+        self.profile = profile
+        self.metadata = metadata
+        self.index_only = index_only
+        self.reconcile = reconcile
+        self.service = service
+        self.result_queue = result_queue
+        self.status_queue = status_queue
+        self.pool_kind = pool_kind
+        self.workers = workers
+        self.scanner = None
+        self.is_running = True
+        self.daemon = True 
 
-            except Exception:
-                pass
+    def run(self):
+        try:
+            if not self.folder_path or not self.input_image_path:
+                return
 
-            # Update progress
-            if index % 20 == 0:
-                progress = (index + 1) / total_files * 100
-                self.status_queue.put(("progress", progress))
-                self.status_queue.put(("status", f"Scanning: {index+1}/{total_files}"))
+            if self.service and self.ask_service():
+                return
 
-            if batch_counter >= 500:
-                conn.commit()
-                batch_counter = 0
+            self.status_queue.put(("status", "Calculating input hash..."))
+            try:
+                input_hashes = resolve_ref_hashes(self.input_image_path, self.algorithm)
+            except ValueError:
+                self.status_queue.put(("status", "Error: Could not read input image."))
+                return
+
+            self.scanner = Scanner(self.folder_path, input_hashes, self.max_dist, algorithm=self.algorithm,
+                                   top_k=self.top_k, stats=self.stats, profile=self.profile, metadata=self.metadata,
+                                   pool_kind=self.pool_kind, workers=self.workers, index_only=self.index_only,
+                                   on_status=lambda kind, data: self.status_queue.put((kind, data)))
+            if not self.is_running:
+                self.scanner.stop()
+
+            seen = set()
+            for res in self.scanner.run():
+                res["size"] = f"{res['bytes'] / (1024 * 1024):.2f} MB"
+                seen.add(res["path"])
+                self.result_queue.put(res)
+
+            if self.index_only and self.reconcile and self.top_k is None and self.is_running:
+                # Deferred check of the rest of the folder: new images, and rows the index had no hash for
+                self.scanner = Scanner(self.folder_path, input_hashes, self.max_dist, algorithm=self.algorithm,
+                                       stats=self.stats, metadata=self.metadata, pool_kind=self.pool_kind,
+                                       workers=self.workers,
+                                       on_status=lambda kind, data: self.status_queue.put((kind, data)))
+                if not self.is_running:
+                    self.scanner.stop()
+                for res in self.scanner.run():
+                    if res["path"] not in seen:
+                        res["size"] = f"{res['bytes'] / (1024 * 1024):.2f} MB"
+                        self.result_queue.put(res)
+
+            self.status_queue.put(("status", "Scan Complete."))
+        except Exception as e:
+            self.status_queue.put(("status", f"Error: {e}"))
+        finally:
+            self.status_queue.put(("done", None))
 
-        if batch_counter > 0:
-            conn.commit()
-            
-        conn.close()
-        self.status_queue.put(("status", "Scan Complete."))
-        self.status_queue.put(("done", None))
+    def ask_service(self):
+        """ Puts the query service's matches on the result queue. False if it can't be reached or rejects the query. """
+        self.status_queue.put(("status", "Asking the query service..."))
+        start = time.time()
+        try:
+            results = ServiceClient(self.service).query(self.folder_path, self.input_image_path, self.max_dist,
+                                                        algorithm=self.algorithm, top_k=self.top_k,
+                                                        metadata=self.metadata)
+        except ValueError as e:
+            self.status_queue.put(("status", f"Query service refused ({e}), scanning locally..."))
+            return False
+        except OSError:
+            self.status_queue.put(("status", "Query service not reachable, scanning locally..."))
+            return False
+        for res in results:
+            if not self.is_running: break
+            res["size"] = f"{res['bytes'] / (1024 * 1024):.2f} MB"
+            self.result_queue.put(res)
+        self.status_queue.put(("status", f"{len(results)} matches from the query service in {time.time() - start:.2f}s"))
+        return True
 
     def stop(self):
         self.is_running = False
+        if self.scanner:
+            self.scanner.stop()
 
 # Select Base Class based on DND availability
 BaseClass = TkinterDnD.Tk if HAS_DND else tk.Tk
@@ -406,16 +707,38 @@ class App(BaseClass):
 
         self.target_folder = ""
         self.input_image_path = ""
+        self.algorithm = "ahash"
+        self.max_dist = MATCH_DISTANCE
+        self.top_k = 0 # 0 = every match, as found
+        self.profile_scan = None # cProfile dump path for the next scan only
+        self.index_only = False # Answer from the index first, walk the folder afterwards
+        self.watch_index = False # Keep every scan root indexed in the background (finder_watch)
+        self.watcher = None
+        self.service_url = None # finder_service URL to send searches to, if one is running
         self.scanner_thread = None
         
-        self.image_cache = [] # Prevent GC
+        # Result model: rows in display order; PhotoImages only for rows near the viewport
+        self.pending_results = collections.deque()
+        self.result_items = [] # Treeview item ids in order
+        self.result_paths = {} # item -> path
+        self.thumbs = {} # item -> PhotoImage (Prevent GC)
+        self.thumb_wanted = set()
+        self.thumb_refresh_pending = False
         self.result_queue = queue.Queue()
         self.status_queue = queue.Queue()
+        self.thumb_queue = queue.Queue()
+        self.thumb_loader = ThumbnailLoader(self.thumb_queue)
+        self.thumb_loader.start()
+        self.meta_text = "" # Full metadata of the selected result, for "Copy All"
+        self.meta_queue = queue.Queue()
+        self.meta_loader = MetadataLoader(self.meta_queue)
+        self.meta_loader.start()
 
         self.load_config()
         self.setup_ui()
         self.check_ready()
         self.check_queue()
+        if self.watch_index: self.start_watcher()
 
     def load_config(self):
         if os.path.exists(CONFIG_FILE):
@@ -423,11 +746,26 @@ class App(BaseClass):
                 with open(CONFIG_FILE, 'r') as f:
                     data = json.load(f)
                     self.target_folder = data.get("last_folder", "")
+                    if data.get("algorithm") in QUERY_ALGORITHMS:
+                        self.algorithm = data["algorithm"]
+                    self.max_dist = int(data.get("max_distance", self.max_dist))
+                    self.top_k = int(data.get("top_k", self.top_k))
+                    self.watch_index = bool(data.get("watch_index", False))
+                    self.index_only = bool(data.get("index_only", False))
+                    self.service_url = data.get("service_url")
+                    # Optional scan telemetry: JSON-lines log and a one-off profile
+                    finder_core.STATS_LOG = data.get("stats_log")
+                    self.profile_scan = data.get("profile_scan")
             except Exception:
                 pass
 
     def save_config(self):
-        data = {"last_folder": self.target_folder}
+        data = {"last_folder": self.target_folder, "algorithm": self.algorithm,
+                "max_distance": self.max_dist, "top_k": self.top_k, "watch_index": self.watch_index,
+                "index_only": self.index_only}
+        if finder_core.STATS_LOG: data["stats_log"] = finder_core.STATS_LOG
+        if self.profile_scan: data["profile_scan"] = self.profile_scan
+        if self.service_url: data["service_url"] = self.service_url
         try:
             with open(CONFIG_FILE, 'w') as f:
                 json.dump(data, f)
@@ -445,6 +783,9 @@ class App(BaseClass):
         self.progress = ttk.Progressbar(self.status_frame, orient=tk.HORIZONTAL, length=200, mode='determinate')
         self.progress.pack(side=tk.RIGHT, padx=5, pady=3)
 
+        self.lbl_stats = tk.Label(self.status_frame, text="", bg="#222222", fg="#777777", font=("Segoe UI", 9))
+        self.lbl_stats.pack(side=tk.RIGHT, padx=10)
+
         # --- MAIN SPLIT ---
         main_pane = tk.PanedWindow(self, orient=tk.HORIZONTAL, sashrelief=tk.FLAT, bg=COLOR_BG, sashwidth=4)
         main_pane.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
@@ -496,6 +837,51 @@ class App(BaseClass):
                             bg="#333333", fg="white", relief=tk.FLAT, pady=5)
         btn_cache.pack(fill=tk.X, pady=(5, 0))
 
+        btn_dupes = tk.Button(left_frame, text="🔍 Near Duplicates", command=self.open_near_duplicates,
+                            bg="#333333", fg="white", relief=tk.FLAT, pady=5)
+        btn_dupes.pack(fill=tk.X, pady=(5, 0))
+
+        self.var_watch = tk.BooleanVar(value=self.watch_index)
+        tk.Checkbutton(left_frame, text="Keep index updated in background", variable=self.var_watch,
+                       command=self.toggle_watcher, bg=COLOR_BG, fg=COLOR_FG,
+                       selectcolor="#444444", activebackground=COLOR_BG).pack(anchor="w", pady=(5, 0))
+
+        # 3b. Hash algorithm for matching
+        frame_algo = tk.Frame(left_frame, bg=COLOR_BG)
+        frame_algo.pack(fill=tk.X, pady=(10, 0))
+        tk.Label(frame_algo, text="Match by:", bg=COLOR_BG, fg=COLOR_FG).pack(side=tk.LEFT)
+        self.cmb_algorithm = ttk.Combobox(frame_algo, state="readonly",
+                                          values=[ALGORITHM_LABELS[a] for a in QUERY_ALGORITHMS])
+        self.cmb_algorithm.set(ALGORITHM_LABELS[self.algorithm])
+        self.cmb_algorithm.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(5, 0))
+        self.cmb_algorithm.bind("<<ComboboxSelected>>", self.on_algorithm_change)
+
+        # 3c. Match threshold and ranked top-K mode (0 = all matches, in scan order)
+        frame_limits = tk.Frame(left_frame, bg=COLOR_BG)
+        frame_limits.pack(fill=tk.X, pady=(5, 0))
+        tk.Label(frame_limits, text="Max distance:", bg=COLOR_BG, fg=COLOR_FG).pack(side=tk.LEFT)
+        self.var_max_dist = tk.IntVar(value=self.max_dist)
+        tk.Spinbox(frame_limits, from_=0, to=64, width=4, textvariable=self.var_max_dist).pack(side=tk.LEFT, padx=5)
+        self.var_top_k = tk.IntVar(value=self.top_k)
+        tk.Spinbox(frame_limits, from_=0, to=10000, width=6, textvariable=self.var_top_k).pack(side=tk.RIGHT)
+        tk.Label(frame_limits, text="Top:", bg=COLOR_BG, fg=COLOR_FG).pack(side=tk.RIGHT, padx=5)
+
+        self.var_index_only = tk.BooleanVar(value=self.index_only)
+        tk.Checkbutton(left_frame, text="Instant results from index", variable=self.var_index_only,
+                       bg=COLOR_BG, fg=COLOR_FG, selectcolor="#444444", activebackground=COLOR_BG).pack(anchor="w")
+
+        # 3d. AI metadata filter, e.g. "seed:123 model:sdxl castle" (see finder_core.parse_metadata_query)
+        frame_meta = tk.Frame(left_frame, bg=COLOR_BG)
+        frame_meta.pack(fill=tk.X, pady=(5, 0))
+        tk.Label(frame_meta, text="Metadata:", bg=COLOR_BG, fg=COLOR_FG).pack(side=tk.LEFT)
+        self.var_meta = tk.StringVar()
+        entry_meta = tk.Entry(frame_meta, textvariable=self.var_meta, bg="#333333", fg="white", insertbackground="white")
+        entry_meta.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(5, 0))
+        entry_meta.bind("<Return>", lambda e: self.search_metadata())
+        btn_meta = tk.Button(left_frame, text="🔎 Search Metadata Only", command=self.search_metadata,
+                             bg="#333333", fg="white", relief=tk.FLAT, pady=5)
+        btn_meta.pack(fill=tk.X, pady=(5, 0))
+
         # 4. Start Button (Big)
         self.btn_search = tk.Button(left_frame, text="START SCAN", command=self.toggle_scan, 
                                     bg=COLOR_ACCENT, fg="white", font=("Segoe UI", 12, "bold"), 
@@ -530,7 +916,10 @@ class App(BaseClass):
         
         # Scrollbar
         vsb = ttk.Scrollbar(tree_frame, orient="vertical", command=self.tree.yview)
-        self.tree.configure(yscrollcommand=vsb.set)
+        def on_tree_scroll(first, last):
+            vsb.set(first, last)
+            self.schedule_thumb_refresh()
+        self.tree.configure(yscrollcommand=on_tree_scroll)
         
         self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         vsb.pack(side=tk.RIGHT, fill=tk.Y)
@@ -589,7 +978,7 @@ class App(BaseClass):
         return "break"
 
     def copy_all_metadata(self):
-        text = self.txt_meta.get("1.0", tk.END).strip()
+        text = self.meta_text.strip()
         if text:
             self.clipboard_clear()
             self.clipboard_append(text)
@@ -598,26 +987,18 @@ class App(BaseClass):
         path = self.get_selected_path()
         if not path: return
 
+        # Indexed generation data first; the file itself only if it wasn't indexed
         found_seed = None
         try:
-            img = Image.open(path)
-            # Automatic1111
-            if 'parameters' in img.info:
-                match = re.search(r"Seed:\s*(\d+)", img.info['parameters'])
-                if match: found_seed = match.group(1)
-            
-            # ComfyUI
-            if not found_seed and 'prompt' in img.info:
-                try:
-                    data = json.loads(img.info['prompt'])
-                    for v in data.values():
-                        inputs = v.get('inputs', {})
-                        if 'seed' in inputs:
-                            found_seed = str(inputs['seed']); break
-                        if 'noise_seed' in inputs:
-                            found_seed = str(inputs['noise_seed']); break
-                except: pass
-        except: pass
+            conn = connect_db()
+            info = lookup_generation_info(conn, path)
+            conn.close()
+        except Exception:
+            info = None
+        if info is None:
+            info = read_generation_info(path)
+        if info:
+            found_seed = info.get("seed")
 
         if found_seed:
             self.clipboard_clear()
@@ -626,9 +1007,68 @@ class App(BaseClass):
         else:
             messagebox.showwarning("Info", "No Seed found.")
 
+    def toggle_watcher(self):
+        self.watch_index = self.var_watch.get()
+        if self.watch_index:
+            self.start_watcher()
+        elif self.watcher:
+            self.watcher.stop()
+            self.watcher = None
+        self.save_config()
+
+    def start_watcher(self):
+        """ Runs an IndexWatcher over every scan root; its messages show while no scan is running. """
+        if self.watcher: return
+        self.watcher = IndexWatcher(on_status=lambda kind, data: self.status_queue.put(("watch", data)))
+        threading.Thread(target=self.watcher.run, daemon=True).start()
+
     def open_cache_manager(self):
         CacheManager(self)
 
+    def clear_results(self):
+        self.pending_results.clear()
+        self.result_items = []
+        self.result_paths = {}
+        self.thumbs = {}
+        self.thumb_wanted = set()
+        self.thumb_loader.reset()
+        for item in self.tree.get_children(): self.tree.delete(item)
+        self.set_metadata_text("")
+
+    def search_metadata(self):
+        """ Lists indexed images under the selected folder whose generation data matches, without scanning. """
+        query = parse_metadata_query(self.var_meta.get())
+        if not query:
+            messagebox.showinfo("Info", "Enter prompt words, seed:123 and/or model:name.")
+            return
+        if self.scanner_thread and self.scanner_thread.is_alive():
+            return
+        self.clear_results()
+        threading.Thread(target=self.run_metadata_search, args=(query, self.target_folder or None), daemon=True).start()
+
+    def run_metadata_search(self, query, folder):
+        try:
+            conn = connect_db()
+            rows = search_metadata(conn, folder=folder, limit=METADATA_RESULTS, **query)
+            conn.close()
+        except Exception as e:
+            self.status_queue.put(("status", f"Metadata search failed: {e}"))
+            return
+        for row in rows:
+            try:
+                size = f"{os.path.getsize(row['path']) / (1024 * 1024):.2f} MB"
+            except OSError:
+                continue
+            self.result_queue.put({"path": row["path"], "name": os.path.basename(row["path"]), "distance": "-", "size": size})
+        self.status_queue.put(("status", f"Metadata search: {len(rows)} images"))
+
+    def on_algorithm_change(self, event):
+        self.algorithm = QUERY_ALGORITHMS[self.cmb_algorithm.current()]
+        self.save_config()
+
+    def open_near_duplicates(self):
+        NearDuplicates(self, self.target_folder)
+
     # --- CORE ---
     def browse_image(self):
         path = filedialog.askopenfilename(filetypes=[("Images", "*.jpg *.jpeg *.png *.webp")])
@@ -673,12 +1113,27 @@ class App(BaseClass):
             self.scanner_thread.stop()
             self.btn_search.config(text="Stopping...", state=tk.DISABLED)
         else:
-            self.image_cache = []
-            for item in self.tree.get_children(): self.tree.delete(item)
-            self.txt_meta.delete(1.0, tk.END)
+            self.clear_results()
+            try:
+                self.max_dist = max(self.var_max_dist.get(), 0)
+                self.top_k = max(self.var_top_k.get(), 0)
+            except tk.TclError:
+                pass
+            self.index_only = self.var_index_only.get()
+            stats = ScanStats()
+            self.thumb_loader.stats = stats
+            self.lbl_stats.config(text="")
             
             self.scanner_thread = ImageScanner(self.target_folder, self.input_image_path, 
-                                             self.result_queue, self.status_queue)
+                                             self.result_queue, self.status_queue, algorithm=self.algorithm,
+                                             max_dist=self.max_dist, top_k=self.top_k or None,
+                                             stats=stats, profile=self.profile_scan,
+                                             metadata=parse_metadata_query(self.var_meta.get()) or None,
+                                             # The watcher already keeps the index current
+                                             index_only=self.index_only, reconcile=self.watcher is None,
+                                             service=self.service_url)
+            self.profile_scan = None
+            self.save_config()
             self.scanner_thread.start()
             self.btn_search.config(text="STOP SCAN", bg="#D32F2F")
 
@@ -688,6 +1143,9 @@ class App(BaseClass):
                 msg_type, data = self.status_queue.get_nowait()
                 if msg_type == "status": self.lbl_status.config(text=data)
                 elif msg_type == "progress": self.progress['value'] = data
+                elif msg_type == "stats": self.lbl_stats.config(text=format_stats(data))
+                elif msg_type == "watch":
+                    if not (self.scanner_thread and self.scanner_thread.is_alive()): self.lbl_status.config(text=data)
                 elif msg_type == "done": 
                     self.btn_search.config(text="START SCAN", bg=COLOR_ACCENT, state=tk.NORMAL)
                     messagebox.showinfo("Scan Complete", "Finished scanning folder.")
@@ -695,21 +1153,69 @@ class App(BaseClass):
 
         try:
             while True:
-                res = self.result_queue.get_nowait()
-                thumb = None
+                self.pending_results.append(self.result_queue.get_nowait())
+        except queue.Empty: pass
+        if self.pending_results:
+            self.insert_pending_results()
+
+        try:
+            while True:
+                item, data = self.thumb_queue.get_nowait()
+                if item not in self.thumb_wanted or item in self.thumbs: continue
                 try:
-                    img = Image.open(res['path'])
-                    img.thumbnail((50, 50))
-                    thumb = ImageTk.PhotoImage(img)
-                    self.image_cache.append(thumb)
+                    thumb = ImageTk.PhotoImage(Image.open(io.BytesIO(data)))
+                    self.thumbs[item] = thumb
+                    self.tree.item(item, image=thumb)
                 except: pass
-                
-                # Insert item
-                self.tree.insert("", "end", text="", image=thumb, 
-                                 values=(res['name'], res['distance'], res['size'], res['path']))
         except queue.Empty: pass
 
-        self.after(100, self.check_queue)
+        try:
+            while True:
+                path, text = self.meta_queue.get_nowait()
+                if path == self.get_selected_path(): self.set_metadata_text(text)
+        except queue.Empty: pass
+
+        # Come back sooner while there is a backlog of rows to insert
+        self.after(10 if self.pending_results else 100, self.check_queue)
+
+    def insert_pending_results(self):
+        """ Inserts queued results for at most RESULT_BATCH_MS so the UI keeps responding. """
+        deadline = time.perf_counter() + RESULT_BATCH_MS / 1000
+        while self.pending_results and time.perf_counter() < deadline:
+            res = self.pending_results.popleft()
+            item = self.tree.insert("", "end", text="", 
+                                    values=(res['name'], res['distance'], res['size'], res['path']))
+            self.result_items.append(item)
+            self.result_paths[item] = res['path']
+        self.schedule_thumb_refresh()
+
+    def schedule_thumb_refresh(self):
+        if not self.thumb_refresh_pending:
+            self.thumb_refresh_pending = True
+            self.after(50, self.refresh_visible_thumbs)
+
+    def refresh_visible_thumbs(self):
+        """ Requests thumbnails for rows near the viewport and frees the ones scrolled away. """
+        self.thumb_refresh_pending = False
+        n = len(self.result_items)
+        first, last = self.tree.yview()
+        lo = max(0, int(first * n) - THUMB_MARGIN)
+        hi = min(n, int(last * n) + 1 + THUMB_MARGIN)
+        visible = self.result_items[lo:hi]
+        wanted = set(visible)
+        if wanted == self.thumb_wanted:
+            return
+
+        for item in [i for i in self.thumbs if i not in wanted]:
+            del self.thumbs[item]
+            if self.tree.exists(item): self.tree.item(item, image="")
+        self.thumb_wanted = wanted
+
+        # Drop queued requests for rows that are no longer on screen
+        self.thumb_loader.reset()
+        for item in visible:
+            if item not in self.thumbs:
+                self.thumb_loader.request(item, self.result_paths[item])
 
     # --- ACTIONS ---
     def on_tree_select(self, event):
@@ -717,27 +1223,17 @@ class App(BaseClass):
         if path: self.show_metadata(path)
 
     def show_metadata(self, path):
-        output = []
-        try:
-            img = Image.open(path)
-            output.append(f"Format: {img.format} | Size: {img.size} | Mode: {img.mode}\n" + "-"*40)
-            
-            if img.info:
-                for k, v in img.info.items():
-                    if k in ['prompt', 'workflow', 'parameters']:
-                        try:
-                            if isinstance(v, str) and (v.startswith('{') or v.startswith('[')):
-                                parsed = json.loads(v)
-                                output.append(f"\n[{k}]:\n{json.dumps(parsed, indent=2)}")
-                            else:
-                                output.append(f"\n[{k}]:\n{v}")
-                        except: output.append(f"\n[{k}]:\n{v}")
-                    else:
-                        output.append(f"[{k}]: {v}")
-        except Exception as e: output.append(f"Error: {e}")
-        
+        """ Reading and formatting happen on the MetadataLoader thread; check_queue shows the result. """
+        self.set_metadata_text("Loading metadata...")
+        self.meta_text = ""
+        self.meta_loader.request(path)
+
+    def set_metadata_text(self, text):
+        self.meta_text = text
+        if len(text) > METADATA_DISPLAY_CHARS:
+            text = text[:METADATA_DISPLAY_CHARS] + f"\n\n... {len(text) - METADATA_DISPLAY_CHARS:,} more characters (use Copy All)"
         self.txt_meta.delete(1.0, tk.END)
-        self.txt_meta.insert(tk.END, "\n".join(output))
+        self.txt_meta.insert(tk.END, text)
 
     def on_double_click(self, event): self.ctx_open_file()
     def show_context_menu(self, event):
@@ -752,10 +1248,7 @@ class App(BaseClass):
 
     def ctx_open_file(self):
         path = self.get_selected_path()
-        if path:
-            if platform.system() == 'Darwin': subprocess.call(('open', path))
-            elif platform.system() == 'Windows': os.startfile(path)
-            else: subprocess.call(('xdg-open', path))
+        if path: open_path(path)
 
     def ctx_open_location(self):
         path = self.get_selected_path()
@@ -782,11 +1275,16 @@ class App(BaseClass):
                 try:
                     os.remove(path)
                     self.tree.delete(selected_item)
+                    for item in selected_item:
+                        self.result_items.remove(item)
+                        self.result_paths.pop(item, None)
+                        self.thumbs.pop(item, None)
                     self.lbl_status.config(text=f"Deleted: {os.path.basename(path)}")
                     self.txt_meta.delete(1.0, tk.END)
                 except Exception as e:
                     messagebox.showerror("Error", f"Could not delete file: {e}")
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support() # Hash pool workers in PyInstaller builds
     app = App()
     app.mainloop()
\ No newline at end of file